@@ -0,0 +1,161 @@
+import gzip
+import random
+
+import numpy as np
+import pandas as pd
+
+"""
+Synthetic data for the benchmarks, seeded so that two runs (or two versions) work on the same data.
+"""
+
+SITES = [f"https://{locale}.example-store.com" for locale in ("www", "fr", "de", "es", "it", "nl", "se", "jp", "us", "au")]
+PATH_TEMPLATES = ["/{slug}/{n}.list",
+                  "/{slug}-{sku}.html",
+                  "/{slug}-{sku}.reviews",
+                  "/blog/{slug}-{n}/",
+                  "/thezone/{slug}/{n}/",
+                  "/{slug}.account",
+                  "/{slug}.trade",
+                  "/{slug}.tesseract",
+                  "/{slug}/{n}/"]
+SLUGS = ["protein", "whey", "vitamins", "clothing", "snacks", "creatine", "bars", "shakers", "vegan", "offers"]
+LOCALES = ["en-gb", "fr-fr", "de-de", "es-es", "it-it", "nl-nl", "sv-se", "ja-jp", "en-us", "en-au"]
+
+
+def crawl_urls(size, seed=0, parameter_rate=0.2, unique_hosts=None):
+    """
+    urls looking like a crawl export : mixed page types, query strings on part of them,
+    and a small number of hosts repeated over and over
+    return:numpy array of urls
+    """
+    rng = np.random.default_rng(seed)
+    sites = SITES if unique_hosts is None else [f"https://h{n}.example-store.com" for n in range(unique_hosts)]
+    site_ids = rng.integers(0, len(sites), size)
+    template_ids = rng.integers(0, len(PATH_TEMPLATES), size)
+    slug_ids = rng.integers(0, len(SLUGS), size)
+    numbers = rng.integers(0, max(size // 10, 10), size)
+    skus = rng.integers(10000000, 99999999, size)
+    with_parameters = rng.random(size) < parameter_rate
+    urls = [sites[site] + PATH_TEMPLATES[template].format(slug=SLUGS[slug], n=n, sku=sku)
+            + (f"?page={n % 7}&sort=price" if parameters else "")
+            for site, template, slug, n, sku, parameters
+            in zip(site_ids, template_ids, slug_ids, numbers, skus, with_parameters)]
+    return np.array(urls, dtype=object)
+
+
+def crawl_export(size, seed=0):
+    """
+    return:dataframe shaped like a crawler csv export
+    """
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({"Address": crawl_urls(size, seed=seed),
+                         "Status Code": rng.choice([200, 200, 200, 301, 404], size),
+                         "Indexability": rng.choice(["Indexable", "Non-Indexable"], size),
+                         "Size (bytes)": rng.integers(1000, 500000, size)})
+
+
+def product_feed(size, seed=0):
+    """
+    return:dataframe shaped like a product feed export, SKUs (8 digits) buried in text columns
+    """
+    rng = np.random.default_rng(seed)
+    skus = rng.integers(10000000, 99999999, size)
+    variants = rng.integers(10000000, 99999999, size)
+    has_variant = rng.random(size) < 0.3
+    return pd.DataFrame({"id": np.arange(size),
+                         "title": [f"{SLUGS[n % len(SLUGS)]} product {sku}" for n, sku in enumerate(skus)],
+                         "link": [f"{SITES[0]}/{SLUGS[n % len(SLUGS)]}-{sku}.html" for n, sku in enumerate(skus)],
+                         "description": [f"bundle of {sku} and {variant}" if variant_flag else "no variant"
+                                         for sku, variant, variant_flag in zip(skus, variants, has_variant)],
+                         "price": rng.uniform(1, 100, size).round(2)})
+
+
+def write_csv(df, filename, chunksize=1000000):
+    """
+    write a generated frame to csv chunk by chunk
+    """
+    for start in range(0, len(df), chunksize):
+        df.iloc[start:start + chunksize].to_csv(filename, mode="w" if start == 0 else "a", header=start == 0, index=False)
+    return filename
+
+
+def write_generated_csv(generator, size, filename, chunksize=1000000, seed=0):
+    """
+    generate and write size rows without holding them all in memory, for the 10M rows sizes
+    """
+    for chunk_number, start in enumerate(range(0, size, chunksize)):
+        chunk = generator(min(chunksize, size - start), seed=seed + chunk_number)
+        chunk.to_csv(filename, mode="w" if start == 0 else "a", header=start == 0, index=False)
+    return filename
+
+
+def sitemap(size, seed=0, lastmod_rate=0.9, compress=False):
+    """
+    return:bytes of a <urlset> sitemap of size urls, part of them without lastmod
+    """
+    rng = random.Random(seed)
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n'
+             '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n']
+    for url in crawl_urls(size, seed=seed, parameter_rate=0):
+        if rng.random() < lastmod_rate:
+            lastmod = f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T10:00:00+00:00"
+            parts.append(f"<url><loc>{url}</loc><lastmod>{lastmod}</lastmod></url>\n")
+        else:
+            parts.append(f"<url><loc>{url}</loc></url>\n")
+    parts.append("</urlset>\n")
+    content = "".join(parts).encode("utf-8")
+    return gzip.compress(content) if compress else content
+
+
+def sitemap_index(child_urls):
+    """
+    return:bytes of a <sitemapindex> pointing to child_urls
+    """
+    entries = "".join(f"<sitemap><loc>{url}</loc></sitemap>\n" for url in child_urls)
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
+            f"{entries}</sitemapindex>\n").encode("utf-8")
+
+
+def hreflang_page(base_url, path, body_size=200000, missing_return_rate=0.0, seed=0):
+    """
+    return:bytes of an html page with one <link hreflang> per locale in its head and a large body
+    """
+    rng = random.Random(f"{seed}{path}")
+    links = "".join(f'<link rel="alternate" hreflang="{locale}" href="{base_url}/{locale}{path}"/>\n'
+                    for locale in LOCALES if rng.random() >= missing_return_rate)
+    body = "<p>" + "lorem ipsum " * (body_size // 12) + "</p>"
+    return f"<html><head><title>{path}</title>\n{links}</head><body>{body}</body></html>".encode("utf-8")
+
+
+def search_analytics_rows(start_row, row_limit, total_rows, dimensions):
+    """
+    return:rows of a searchAnalytics.query response page
+    """
+    return [{"keys": [f"{dimension} {n}" for dimension in dimensions],
+             "clicks": n % 50,
+             "impressions": n % 500 + 50,
+             "ctr": (n % 50) / (n % 500 + 50),
+             "position": 1 + n % 30}
+            for n in range(start_row, min(start_row + row_limit, total_rows))]
+
+
+def analytics_report(report_request, total_rows):
+    """
+    return:a core reporting report for report_request, paged with pageSize/pageToken
+    """
+    page_size = int(report_request.get("pageSize", 1000))
+    start = int(report_request.get("pageToken", 0))
+    dimensions = [dimension["name"] for dimension in report_request.get("dimensions", [])]
+    metrics = report_request.get("metrics", [])
+    rows = [{"dimensions": [f"{dimension}/{n}" for dimension in dimensions],
+             "metrics": [{"values": [str(n % (index + 7)) for index, _ in enumerate(metrics)]}]}
+            for n in range(start, min(start + page_size, total_rows))]
+    report = {"columnHeader": {"dimensions": dimensions,
+                               "metricHeader": {"metricHeaderEntries": [
+                                   {"name": metric.get("alias", metric["expression"]), "type": "INTEGER"}
+                                   for metric in metrics]}},
+              "data": {"rows": rows, "rowCount": total_rows}}
+    if start + page_size < total_rows:
+        report["nextPageToken"] = str(start + page_size)
+    return report
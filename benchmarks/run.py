@@ -0,0 +1,277 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+import pandas as pd
+
+import generators
+import getsitemaps
+import split_file
+import utilities
+from stub_server import StubServer
+
+"""
+Benchmarks of the library hot paths, no network needed : data is generated and the http endpoints are served locally.
+usage :
+python benchmarks/run.py --sizes 10000,100000 --output results.json
+python benchmarks/run.py --compare before.json after.json
+Every benchmark reports throughput (rows per second of the median run), latency percentiles of the runs
+and the peak memory allocated by python (tracemalloc, measured on a separate run).
+"""
+
+DEFAULT_SIZES = [10000, 100000]
+# larger sizes (ie: the 10M rows tier) are only written to disk and streamed
+IN_MEMORY_MAX_SIZE = 1000000
+
+
+def percentile(timings, q):
+    ordered = sorted(timings)
+    position = (len(ordered) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def measure(name, size, function, rows, repeat=3):
+    """
+    run function repeat times for timings, then once more under tracemalloc for the peak memory
+    return:dict of results
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    median = statistics.median(timings)
+    result = {"benchmark": name,
+              "size": size,
+              "rows": rows,
+              "runs": repeat,
+              "rows_per_second": rows / median if median else None,
+              "latency_p50": median,
+              "latency_p90": percentile(timings, 0.9),
+              "latency_p99": percentile(timings, 0.99),
+              "latency_min": min(timings),
+              "peak_memory_bytes": peak}
+    print(f"{name:32} {size:>10} {result['rows_per_second'] or 0:>14,.0f} rows/s "
+          f"p50 {median * 1000:>9.1f} ms  peak {peak / 2 ** 20:>8.1f} MiB")
+    return result
+
+
+def without_size_column(size, seed=0):
+    return generators.crawl_export(size, seed=seed).drop(columns=["Size (bytes)"]).assign(extra="x")
+
+
+def cold(function, *args):
+    """
+    run function with an empty host cache, so that the netloc benchmarks don't depend on the ones run before
+    """
+    utilities.split_host.cache_clear()
+    return function(*args)
+
+
+def data_benchmarks(size, workdir):
+    """
+    The csv files are generated chunk by chunk straight to disk, past IN_MEMORY_MAX_SIZE rows
+    the benchmarks working on dataframes or bytes held in memory are skipped
+    return:list of (name, function, rows) working on generated data of size rows
+    """
+    crawl_csv = generators.write_generated_csv(generators.crawl_export, size, os.path.join(workdir, f"crawl_{size}.csv"))
+
+    fragments = []
+    fragment_size = max(size // 8, 1)
+    for n, start in enumerate(range(0, size, fragment_size)):
+        # a different seed per fragment, the chunks of write_generated_csv take seed + chunk number
+        fragments.append(generators.write_generated_csv(generators.crawl_export, min(fragment_size, size - start),
+                                                        os.path.join(workdir, f"fragment_{size}_{n}.csv"),
+                                                        seed=n * 1000))
+    other_schema = generators.write_generated_csv(without_size_column, fragment_size,
+                                                  os.path.join(workdir, f"other_schema_{size}.csv"))
+    destination = os.path.join(workdir, "merged.csv")
+
+    benchmarks = [("count_urls_by_type_csv", lambda: utilities.count_urls_by_type_csv(crawl_csv), size),
+                  ("merge_csv_files_same_schema", lambda: utilities.merge_csv_files(fragments, destination), size),
+                  ("merge_csv_files_union_schema",
+                   lambda: utilities.merge_csv_files(fragments + [other_schema], destination), size + fragment_size),
+                  ("split_datafile_csv",
+                   lambda: split_file.split_datafile(crawl_csv, step=8, output_name="split"), size),
+                  ]
+    if size > IN_MEMORY_MAX_SIZE:
+        print(f"{size} rows : only the benchmarks streaming csv files are run")
+        return benchmarks
+
+    # the public suffix snapshot is loaded once per process, outside of the netloc timings
+    utilities.offline_tld_extract()
+    crawl = generators.crawl_export(size)
+    feed = generators.product_feed(size)
+    urls = crawl["Address"]
+    sitemap = generators.sitemap(size)
+    return [("parse_sitemap", lambda: sum(1 for _ in getsitemaps.parse_sitemap(sitemap)), size),
+            ("count_urls_by_type", lambda: utilities.count_urls_by_type(crawl), size),
+            ("netlocs", lambda: cold(utilities.netlocs, urls), size),
+            ("netloc_apply", lambda: cold(urls.map, utilities.netloc), size),
+            ("extract_skus", lambda: utilities.extract_skus(feed, ["title", "description"]), size),
+            ] + benchmarks
+
+
+def http_benchmarks(server, sites, pages):
+    """
+    return:list of (name, function, rows) hitting the stub server
+    """
+    site_list = [f"{server.base_url}/site{n}/" for n in range(sites)]
+    # post-sitemap.xml and the 2 children of post-sitemap1.xml (half the size each) per site
+    sitemap_rows = sites * server.sitemap_size * 2
+    page_urls = [f"{server.base_url}/hreflang/en-gb/product-{n}.html" for n in range(pages)]
+
+    benchmarks = [("get_sitemaps", lambda: getsitemaps.get_sitemaps(site_list), sitemap_rows),
+                  ("get_hreflang_batch", lambda: utilities.get_hreflang_batch(page_urls), pages)]
+    return benchmarks + google_benchmarks(server)
+
+
+def google_benchmarks(server):
+    """
+    Search Console and core reporting clients pointed at the stub, skipped when the google client libraries are missing
+    """
+    try:
+        import google_apis
+        from googleapiclient import discovery_cache
+    except ImportError as error:
+        print("skipping google api benchmarks", error)
+        return []
+
+    class NoCredentials(object):
+        def authorize(self, http):
+            return http
+
+    def stub_client(api_class, api_name, api_version):
+        class StubClient(api_class):
+            def get_credentials(self):
+                return NoCredentials()
+
+            def discovery_document(self, max_age=0):
+                document = json.loads(discovery_cache.get_static_doc(api_name, api_version))
+                document["rootUrl"] = server.base_url + "/"
+                return json.dumps(document)
+
+        return StubClient(api_name, api_version, "", "", "", "", qps=100000)
+
+    search_console = stub_client(google_apis.SearchConsole, "webmasters", "v3")
+    analytics = stub_client(google_apis.Analytics, "analyticsreporting", "v4")
+    search_request = {"startDate": "2024-01-01", "endDate": "2024-01-01", "dimensions": ["query", "page"],
+                      "rowLimit": 25000}
+    report_requests = [{"viewId": "1",
+                        "dateRanges": [{"startDate": "2024-01-01", "endDate": "2024-01-31"}],
+                        "metrics": [{"expression": "ga:sessions", "alias": "sessions"}],
+                        "dimensions": [{"name": "ga:landingPagePath"}],
+                        "pageSize": 10000} for _ in range(5)]
+
+    return [("search_analytics_to_df",
+             lambda: search_console.search_analytics_to_df("https://www.example.com/", search_request),
+             server.search_analytics_rows),
+            ("analytics_get_reports", lambda: analytics.get_reports(report_requests), 5 * server.report_rows)]
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARKS_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes=DEFAULT_SIZES, repeat=3, only=None, http=True, sites=20, pages=200, sitemap_size=10000, latency=0.0):
+    """
+    return:dict with the environment and the list of results
+    """
+    results = []
+    original_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        # functions writing next to the cwd (split files, distribution images...) write in the temp folder
+        os.chdir(workdir)
+        try:
+            for size in sizes:
+                for name, function, rows in data_benchmarks(size, workdir):
+                    if only is None or name in only:
+                        results.append(measure(name, size, function, rows, repeat=repeat))
+            if http:
+                with StubServer(sitemap_size=sitemap_size, latency=latency) as server:
+                    for name, function, rows in http_benchmarks(server, sites, pages):
+                        if only is None or name in only:
+                            results.append(measure(name, rows, function, rows, repeat=repeat))
+        finally:
+            os.chdir(original_cwd)
+
+    return {"revision": git_revision(),
+            "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "platform": platform.platform(),
+            "results": results}
+
+
+def compare(before_file, after_file):
+    """
+    print the speedup and memory ratio of every benchmark present in both result files
+    """
+    with open(before_file) as before_json, open(after_file) as after_json:
+        before = {(result["benchmark"], result["size"]): result for result in json.load(before_json)["results"]}
+        after = {(result["benchmark"], result["size"]): result for result in json.load(after_json)["results"]}
+    print(f"{'benchmark':32} {'size':>10} {'speedup':>9} {'memory':>9}")
+    for key in sorted(set(before) & set(after)):
+        speedup = before[key]["latency_p50"] / after[key]["latency_p50"]
+        memory = after[key]["peak_memory_bytes"] / max(before[key]["peak_memory_bytes"], 1)
+        print(f"{key[0]:32} {key[1]:>10} {speedup:>8.2f}x {memory:>8.2f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="benchmarks of the utilities hot paths")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="comma separated number of rows, ie: 10000,1000000,10000000")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", default=None, help="comma separated benchmark names")
+    parser.add_argument("--no-http", action="store_true", help="skip the benchmarks using the local http server")
+    parser.add_argument("--sites", type=int, default=20, help="sites crawled by get_sitemaps")
+    parser.add_argument("--pages", type=int, default=200, help="pages crawled by get_hreflang_batch")
+    parser.add_argument("--sitemap-size", type=int, default=10000, help="urls per sitemap served by the stub")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds of simulated round trip per request")
+    parser.add_argument("--output", default=None, help="json file where the results are written")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two result files")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        sys.exit(0)
+
+    report = run(sizes=[int(size) for size in args.sizes.split(",")],
+                 repeat=args.repeat,
+                 only=set(args.only.split(",")) if args.only else None,
+                 http=not args.no_http,
+                 sites=args.sites,
+                 pages=args.pages,
+                 sitemap_size=args.sitemap_size,
+                 latency=args.latency)
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        print(json.dumps(report["results"], indent=2))
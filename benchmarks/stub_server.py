@@ -0,0 +1,137 @@
+import json
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import generators
+
+"""
+Local HTTP server standing in for the sites and Google APIs hit by the library, so the benchmarks need no network.
+routes :
+GET /site{n}/post-sitemap.xml : urlset sitemap of sitemap_size urls
+GET /site{n}/post-sitemap1.xml : sitemap index of 2 gzipped children /site{n}/child-{k}.xml.gz
+GET /hreflang/{locale}/{path} : html page with hreflang links in its head and a large body
+POST /webmasters/v3/sites/{site}/searchAnalytics/query : paged searchAnalytics rows
+POST /v4/reports:batchGet : paged core reporting reports
+anything else is a 404
+"""
+
+
+class QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients hanging up early (ie: reading only the <head> of a page) are expected
+        if not isinstance(sys.exc_info()[1], (ConnectionError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+class StubServer(object):
+    """
+    start()/stop() or use as a context manager, base_url is set once started.
+    latency: seconds slept before answering each request, to simulate a round trip
+    """
+
+    def __init__(self, sitemap_size=10000, search_analytics_rows=100000, report_rows=20000, latency=0.0,
+                 page_body_size=200000):
+        self.sitemap_size = sitemap_size
+        self.search_analytics_rows = search_analytics_rows
+        self.report_rows = report_rows
+        self.latency = latency
+        self.page_body_size = page_body_size
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._cache = {}
+        self.base_url = None
+
+    def content(self, key, build):
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = build()
+            return self._cache[key]
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def reply(self, status, body=b"", content_type="application/xml"):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def before(self):
+                with stub._lock:
+                    stub.requests += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+
+            def do_GET(self):
+                self.before()
+                path = self.path.split("?", 1)[0]
+                if re.fullmatch(r"/site\d+/post-sitemap\.xml", path):
+                    body = stub.content("sitemap", lambda: generators.sitemap(stub.sitemap_size))
+                    return self.reply(200, body)
+                match = re.fullmatch(r"(/site\d+)/post-sitemap1\.xml", path)
+                if match:
+                    children = [f"{stub.base_url}{match.group(1)}/child-{k}.xml.gz" for k in range(2)]
+                    return self.reply(200, generators.sitemap_index(children))
+                match = re.fullmatch(r"/site\d+/child-(\d+)\.xml\.gz", path)
+                if match:
+                    body = stub.content(f"child{match.group(1)}",
+                                        lambda: generators.sitemap(stub.sitemap_size // 2, seed=int(match.group(1)) + 1,
+                                                                   compress=True))
+                    return self.reply(200, body, content_type="application/x-gzip")
+                match = re.fullmatch(r"/hreflang/([^/]+)(/.*)", path)
+                if match:
+                    body = generators.hreflang_page(f"{stub.base_url}/hreflang", match.group(2),
+                                                    body_size=stub.page_body_size)
+                    return self.reply(200, body, content_type="text/html")
+                return self.reply(404)
+
+            def do_POST(self):
+                self.before()
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                path = self.path.split("?", 1)[0]
+                if path.endswith("/searchAnalytics/query"):
+                    rows = generators.search_analytics_rows(int(body.get("startRow", 0)),
+                                                            int(body.get("rowLimit", 1000)),
+                                                            stub.search_analytics_rows,
+                                                            body.get("dimensions", []))
+                    response = {"rows": rows} if rows else {}
+                elif path.endswith("/reports:batchGet"):
+                    response = {"reports": [generators.analytics_report(report_request, stub.report_rows)
+                                            for report_request in body.get("reportRequests", [])]}
+                else:
+                    return self.reply(404)
+                return self.reply(200, json.dumps(response).encode("utf-8"), content_type="application/json")
+
+        return Handler
+
+    def start(self):
+        self._server = QuietServer(("127.0.0.1", 0), self.handler())
+        self.base_url = f"http://127.0.0.1:{self._server.server_address[1]}"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -1,6 +1,22 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import threading
+import contextvars
+import datetime
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
+
 import requests
 import pandas as pd
 from lxml import etree
+from requests.adapters import HTTPAdapter
+
+import instrumentation
 
 """
 #to use this as a custom library you should have this at the top of your scripts :
@@ -9,58 +25,616 @@ sys.path.insert(0, "C:\\python_projects\\custom_libraries")
 """
 
 
-def get_sitemaps(list_of_sites=[],
-                 slugs=["post-sitemap.xml", "post_sitemap_1.xml", "post_sitemap_2.xml", "post_sitemap_3.xml", "post-sitemap1.xml", "post-sitemap2.xml", "post-sitemap3.xml"],):
+def build_session(pool_size=4, hosts=32):
     """
-    Pass a list of sites you want to check the sitemap for,
-    :params: list of sites like this : https://www.example.com
-    :return: concatenated dataframe
+    Session shared by all the fetching threads so connections are kept alive and reused per host.
+    :param pool_size: max number of connections kept open per host, should be >= per_host limit
+    :param hosts: number of per host pools kept, past it the least recently used pool is closed
+    so it should be >= the number of hosts crawled at the same time
+    :return: requests.Session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max(hosts, 1), pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def url_fetcher(session, per_host=4, timeout=30, headers=None, request=None):
+    """
+    :return: fetch(url, url_headers=None) -> (url, response or None on connection error),
+    at most per_host requests at once per host, url_headers replaces headers.get(url)
+    """
+    host_locks = defaultdict(lambda: threading.BoundedSemaphore(per_host))
+    registry_lock = threading.Lock()
+
+    def host_semaphore(url):
+        with registry_lock:
+            return host_locks[urlparse(url).netloc]
+
+    get = request or (lambda session, url, **kwargs: session.get(url, **kwargs))
+
+    def fetch(url, url_headers=None):
+        if url_headers is None:
+            url_headers = (headers or {}).get(url)
+        with host_semaphore(url):
+            instrumentation.add("requests")
+            try:
+                response = get(session, url, timeout=timeout, headers=url_headers)
+            except requests.RequestException as error:
+                print(url, error)
+                instrumentation.add("errors")
+                return url, None
+            if isinstance(response, requests.Response) and instrumentation.is_enabled():
+                instrumentation.add("bytes", len(response.content))
+            return url, response
+
+    return fetch
+
+
+@instrumentation.instrumented(kind="network")
+def fetch_urls(urls, session=None, max_workers=32, per_host=4, timeout=30, headers=None, request=None):
+    """
+    Fetch a list of urls concurrently with a bounded thread pool.
+    :param urls: list of urls to fetch
+    :param session: requests.Session, one is built if not given
+    :param max_workers: global limit of requests in flight
+    :param per_host: max concurrent requests against a single host
+    :param timeout: seconds before a request is abandoned
+    :param headers: optional dict of url -> extra request headers (ie: conditional headers)
+    :param request: optional callable(session, url, timeout=..., headers=...) replacing session.get,
+    ie: to stream only part of the body. Whatever it returns is used as the response
+    :return: list of (url, response) in the same order as urls, response is None on connection error
+    """
+    session = session or build_session(pool_size=max(per_host, 1), hosts=len({urlparse(url).netloc for url in urls}))
+    fetch = url_fetcher(session, per_host=per_host, timeout=timeout, headers=headers, request=request)
+
+    if max_workers <= 1:
+        return [fetch(url) for url in urls]
+    # each task runs in a copy of the caller context so metrics recorded by the workers are attributed to this call
+    contexts = [contextvars.copy_context() for _ in urls]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda context, url: context.run(fetch, url), contexts, urls))
+
+
+def iter_fetch_urls(urls, session=None, max_workers=32, per_host=4, timeout=30, headers=None, request=None,
+                    lookahead=None, fetch=None, executor=None):
+    """
+    Same as fetch_urls but yields (url, response) as soon as each response arrives, in completion order.
+    At most max_workers + lookahead (default max_workers) responses are fetched ahead of the consumer,
+    so the bodies held in memory don't depend on the number of urls.
+    :param fetch: optional url_fetcher shared between calls, its per host limits then hold across all of them
+    :param executor: optional thread pool shared between calls (ie: down the sitemap index recursion)
+    so that max_workers bounds the requests in flight across all of them
+    """
+    urls = list(urls)
+    if fetch is None:
+        session = session or build_session(pool_size=max(per_host, 1),
+                                           hosts=len({urlparse(url).netloc for url in urls}))
+        fetch = url_fetcher(session, per_host=per_host, timeout=timeout, request=request)
+
+    if executor is None and max_workers <= 1:
+        for url in urls:
+            yield fetch(url, (headers or {}).get(url))
+        return
+
+    owned = executor is None
+    if owned:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+    remaining = iter(urls)
+    pending = set()
+
+    def submit_next():
+        url = next(remaining, None)
+        if url is not None:
+            pending.add(executor.submit(contextvars.copy_context().run, fetch, url, (headers or {}).get(url)))
+
+    try:
+        for _ in range(max_workers + (max_workers if lookahead is None else lookahead)):
+            submit_next()
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.discard(future)
+                submit_next()
+                yield future.result()
+    finally:
+        # the consumer stopped early, queued fetches are dropped
+        for future in pending:
+            future.cancel()
+        if owned:
+            executor.shutdown()
+
+
+SITEMAP_TAGS = ("{*}url", "{*}sitemap")
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def decode_sitemap(content):
+    """
+    return the raw xml bytes of a sitemap, gunzipping .xml.gz payloads the server didn't decode
+    """
+    if content[:2] == GZIP_MAGIC:
+        return gzip.decompress(content)
+    return content
+
+
+class SitemapCache(object):
+    """
+    Local snapshot of every sitemap fetched, one json file per sitemap url in cache_dir.
+    Each entry keeps the ETag/Last-Modified validators sent back by the server,
+    the rows parsed from the sitemap and the child sitemaps when it is a sitemap index.
     """
 
-    def get_page(url):
-        return requests.get(url)
+    def __init__(self, cache_dir="sitemap_cache"):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, url):
+        try:
+            with open(self.path(url), "r", encoding="utf-8") as cached:
+                return json.load(cached)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, url, response, rows, children):
+        entry = {"url": url,
+                 "etag": response.headers.get("ETag"),
+                 "last_modified": response.headers.get("Last-Modified"),
+                 "rows": rows,
+                 "children": children}
+        tmp_path = self.path(url) + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as cached:
+            json.dump(entry, cached)
+        os.replace(tmp_path, self.path(url))
+
+    def delete(self, url):
+        try:
+            os.remove(self.path(url))
+        except OSError:
+            pass
 
-    def write_xml_response_to_file(response, filename="xml_sitemap.xml"):
+    def conditional_headers(self, urls):
         """
-        writes to file and return filename so that it can be passed to processing function
+        :return: dict of url -> If-None-Match/If-Modified-Since headers for the urls already cached
         """
-        with open(filename, "wb") as output:
-            output.write(response.content)
-        return filename
+        headers = {}
+        for url in urls:
+            entry = self.get(url)
+            if entry is None:
+                continue
+            url_headers = {}
+            if entry.get("etag"):
+                url_headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                url_headers["If-Modified-Since"] = entry["last_modified"]
+            if url_headers:
+                headers[url] = url_headers
+        return headers
 
-    def parse_sitemap(xml_file_path):
+    def snapshot(self, urls, max_depth=3):
         """
-        parse sitemap to get urls, and return it with last modified nicely formatted into a dataframe.
-        ready to be put as a csv
+        rows of the previous crawl reachable from urls, following cached sitemap index children
+        :return: generator of row dicts
         """
-        parser = etree.XMLParser(ns_clean=True)
-        tree = etree.parse(xml_file_path)
-        root = tree.getroot()
-        data = [[url.findall(".//{http://www.sitemaps.org/schemas/sitemap/0.9}loc")[0].text for url in root], [url.findall(".//{http://www.sitemaps.org/schemas/sitemap/0.9}lastmod")[0].text for url in root]]
-        data_df = pd.DataFrame(data).T
-        data_df.columns = ["url", "last_modified"]
-        return data_df
-
-    def build_sitemap_urls(site_list=[], slug_list=[]):
-        """slug is all the stuff common to a pattern, adapt according to case"""
-        all_urls = ["".join([site, slug]) for site in site_list for slug in slug_list]
-        return all_urls
-
-    list_of_sites = list_of_sites
+        for url in urls:
+            entry = self.get(url)
+            if entry is None:
+                continue
+            yield from entry["rows"]
+            if max_depth > 0:
+                yield from self.snapshot(entry["children"], max_depth=max_depth - 1)
+
+
+def parse_sitemap(content, children=None):
+    """
+    Stream a sitemap straight from the response bytes, elements are cleared as soon as they are read
+    so memory stays flat whatever the size of the sitemap.
+    :param content: bytes of the sitemap, gzipped or not
+    :param children: optional list, <sitemapindex> entries are appended to it instead of being yielded
+    :return: generator of {"url":..., "last_modified":...} dicts, last_modified is None when missing
+    """
+    context = etree.iterparse(io.BytesIO(decode_sitemap(content)),
+                              events=("end",),
+                              tag=SITEMAP_TAGS,
+                              resolve_entities=False,
+                              no_network=True,
+                              huge_tree=True)
+    try:
+        for _, element in context:
+            # a scan of the few children is about twice as fast as findtext with a {*} wildcard
+            loc = last_modified = None
+            for child in element:
+                tag = child.tag
+                if not isinstance(tag, str):
+                    continue
+                if tag == "loc" or tag.endswith("}loc"):
+                    loc = child.text
+                elif tag == "lastmod" or tag.endswith("}lastmod"):
+                    last_modified = child.text
+            is_index_entry = element.tag == "sitemap" or element.tag.endswith("}sitemap")
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+            if loc is None:
+                continue
+            loc = loc.strip()
+            if is_index_entry:
+                if children is not None:
+                    children.append(loc)
+            else:
+                yield {"url": loc,
+                       "last_modified": last_modified.strip() if last_modified else None}
+    except etree.XMLSyntaxError as error:
+        print("invalid sitemap", error)
+    finally:
+        del context
+
+
+def iter_response_rows(url, response, session=None, max_workers=32, per_host=4, max_depth=3, cache=None,
+                       with_source=False, fetch=None, executor=None):
+    """
+    Rows of a fetched sitemap, sitemap index children are fetched and parsed the same way.
+    With a cache, a 304 answer is served from the local snapshot without any parsing
+    and fresh answers are written back to the cache.
+    :param with_source: add the url of the sitemap listing each row under "sitemap"
+    :param fetch / executor: url_fetcher and thread pool shared down the recursion, see iter_fetch_urls
+    :return: generator of {"url":..., "last_modified":...} dicts
+    """
+    children = []
+    cached = cache.get(url) if cache is not None and response.status_code == 304 else None
+    if cached is not None:
+        if with_source:
+            for row in cached["rows"]:
+                yield dict(row, sitemap=url)
+        else:
+            yield from cached["rows"]
+        children = cached["children"]
+    elif response.status_code == 200:
+        rows = []
+        for row in parse_sitemap(response.content, children):
+            rows.append(row)
+            yield dict(row, sitemap=url) if with_source else row
+        if cache is not None:
+            cache.put(url, response, rows, children)
+    else:
+        print(url, response.status_code)
+        if cache is not None and response.status_code in (404, 410):
+            cache.delete(url)
+        return
+
+    if children and max_depth > 0:
+        yield from iter_children_rows(children,
+                                      session=session,
+                                      max_workers=max_workers,
+                                      per_host=per_host,
+                                      max_depth=max_depth - 1,
+                                      cache=cache,
+                                      with_source=with_source,
+                                      fetch=fetch,
+                                      executor=executor)
+
+
+def iter_children_rows(children, session=None, max_workers=32, per_host=4, max_depth=2, cache=None,
+                       with_source=False, fetch=None, executor=None):
+    """
+    Rows of the children of a sitemap index, parsed as their responses arrive.
+    The url_fetcher and the thread pool are built once and shared by every nested index below,
+    so max_workers and per_host hold across the whole recursion.
+    :return: generator of {"url":..., "last_modified":...} dicts
+    """
+    if fetch is None:
+        session = session or build_session(pool_size=max(per_host, 1),
+                                           hosts=len({urlparse(url).netloc for url in children}))
+        fetch = url_fetcher(session, per_host=per_host)
+    owned = executor is None and max_workers > 1
+    if owned:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        headers = cache.conditional_headers(children) if cache is not None else None
+        for child_url, child_response in iter_fetch_urls(children,
+                                                         max_workers=max_workers,
+                                                         headers=headers,
+                                                         fetch=fetch,
+                                                         executor=executor):
+            if child_response is None:
+                continue
+            yield from iter_response_rows(child_url,
+                                          child_response,
+                                          max_workers=max_workers,
+                                          max_depth=max_depth,
+                                          cache=cache,
+                                          with_source=with_source,
+                                          fetch=fetch,
+                                          executor=executor)
+    finally:
+        if owned:
+            executor.shutdown(cancel_futures=True)
+
+
+def iter_sitemap_rows(content, session=None, max_workers=32, per_host=4, max_depth=3, fetch=None, executor=None):
+    """
+    Stream the rows of a sitemap held in memory, <sitemapindex> children are fetched and parsed the same way.
+    :param content: bytes of the sitemap, gzipped or not
+    :param session: requests.Session used to follow sitemap index children
+    :param max_depth: how many levels of nested sitemap indexes are followed
+    :param fetch / executor: url_fetcher and thread pool shared down the recursion, see iter_fetch_urls
+    :return: generator of {"url":..., "last_modified":...} dicts
+    """
+    children = []
+    yield from parse_sitemap(content, children)
+    if children and max_depth > 0:
+        yield from iter_children_rows(children,
+                                      session=session,
+                                      max_workers=max_workers,
+                                      per_host=per_host,
+                                      max_depth=max_depth - 1,
+                                      fetch=fetch,
+                                      executor=executor)
+
+
+def build_sitemap_urls(site_list=[], slug_list=[]):
+    """slug is all the stuff common to a pattern, adapt according to case"""
+    all_urls = ["".join([site, slug]) for site in site_list for slug in slug_list]
+    return all_urls
+
+
+def iter_sitemaps(list_of_sites=[],
+                  slugs=["post-sitemap.xml", "post_sitemap_1.xml", "post_sitemap_2.xml", "post_sitemap_3.xml", "post-sitemap1.xml", "post-sitemap2.xml", "post-sitemap3.xml"],
+                  max_workers=32,
+                  per_host=4,
+                  cache=None,
+                  with_source=False):
+    """
+    Same as get_sitemaps but yields rows as they are parsed instead of building a dataframe.
+    Sitemaps are parsed in the order their responses arrive, only a bounded number of them is held in memory.
+    :param cache: optional SitemapCache, sends conditional requests and skips parsing unchanged sitemaps
+    :param with_source: add the site and the sitemap listing each row under "site" and "sitemap"
+    :return: generator of {"url":..., "last_modified":...} dicts
+    """
     # Could be replaced by a file if needed
     slugs = list(set(slugs))
-    sitemap_dfs = []
-    for url in build_sitemap_urls(list_of_sites, slugs):
-
-        response = get_page(url)
-        if response.status_code != 404:
-            print(url)
-            print(response.status_code)
-            write_xml_response_to_file(response)
-            # write xml create xml file and return the name to be passed in the parser function
-            urls_in_sitemap = parse_sitemap(write_xml_response_to_file(response))
-            sitemap_dfs.append(urls_in_sitemap)
-        else:
-            print(response.status_code)
-            pass
-    return pd.concat(sitemap_dfs, ignore_index=True)
+    # sitemap index children can live on other hosts than the sites
+    session = build_session(pool_size=max(per_host, 1), hosts=max(len(list_of_sites), max_workers))
+    sitemap_urls = build_sitemap_urls(list_of_sites, slugs)
+    sites = {"".join([site, slug]): site for site in list_of_sites for slug in slugs}
+    headers = cache.conditional_headers(sitemap_urls) if cache is not None else None
+    # one fetcher and one pool for the sites and all their index children, the limits hold across the recursion
+    fetch = url_fetcher(session, per_host=per_host)
+    executor = ThreadPoolExecutor(max_workers=max_workers) if max_workers > 1 else None
+    try:
+        # sitemaps are parsed as they arrive instead of once every site was fetched
+        responses = iter_fetch_urls(sitemap_urls, max_workers=max_workers, headers=headers, fetch=fetch,
+                                    executor=executor)
+        for url, response in responses:
+            if response is None:
+                continue
+            if response.status_code != 404:
+                print(url)
+                print(response.status_code)
+            rows = iter_response_rows(url,
+                                      response,
+                                      max_workers=max_workers,
+                                      cache=cache,
+                                      with_source=with_source,
+                                      fetch=fetch,
+                                      executor=executor)
+            if with_source:
+                for row in rows:
+                    # rows are already copies of the parsed or cached ones
+                    row["site"] = sites[url]
+                    yield row
+            else:
+                yield from rows
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+
+SOURCE_COLUMNS = ["url", "last_modified", "site", "sitemap"]
+
+
+@instrumentation.instrumented(kind="network", rows=len)
+def get_sitemaps(list_of_sites=[],
+                 slugs=["post-sitemap.xml", "post_sitemap_1.xml", "post_sitemap_2.xml", "post_sitemap_3.xml", "post-sitemap1.xml", "post-sitemap2.xml", "post-sitemap3.xml"],
+                 max_workers=32,
+                 per_host=4,
+                 cache_dir=None,
+                 with_source=False):
+    """
+    Pass a list of sites you want to check the sitemap for,
+    :params: list of sites like this : https://www.example.com
+    :param max_workers: global number of requests in flight, 1 fetches sequentially
+    :param per_host: max concurrent requests against the same site
+    :param cache_dir: optional folder of the local sitemap snapshot, unchanged sitemaps are then served from it
+    :param with_source: add site and sitemap (categorical) columns, where each url was found
+    :return: concatenated dataframe
+    """
+    cache = SitemapCache(cache_dir) if cache_dir else None
+    rows = iter_sitemaps(list_of_sites, slugs, max_workers=max_workers, per_host=per_host, cache=cache,
+                         with_source=with_source)
+    if not with_source:
+        return pd.DataFrame(list(rows), columns=["url", "last_modified"])
+    return pd.DataFrame(list(rows), columns=SOURCE_COLUMNS).astype({"site": "category", "sitemap": "category"})
+
+
+def sitemap_delta(previous_df, current_df):
+    """
+    compare two sitemap crawls
+    :return: dataframe of url, last_modified, previous_last_modified, change
+    where change is one of "added", "removed", "modified"
+    """
+    previous_df = previous_df.drop_duplicates(subset="url")
+    current_df = current_df.drop_duplicates(subset="url")
+    merged = current_df.merge(previous_df,
+                              on="url",
+                              how="outer",
+                              suffixes=("", "_previous"),
+                              indicator=True)
+    merged = merged.rename(columns={"last_modified_previous": "previous_last_modified"})
+    merged["change"] = None
+    merged.loc[merged["_merge"] == "left_only", "change"] = "added"
+    merged.loc[merged["_merge"] == "right_only", "change"] = "removed"
+    modified = ((merged["_merge"] == "both") &
+                (merged["last_modified"].fillna("") != merged["previous_last_modified"].fillna("")))
+    merged.loc[modified, "change"] = "modified"
+    delta = merged[merged["change"].notna()]
+    return delta[["url", "last_modified", "previous_last_modified", "change"]].reset_index(drop=True)
+
+
+@instrumentation.instrumented(kind="network", rows=lambda result: len(result[0]))
+def get_sitemaps_delta(list_of_sites=[],
+                       slugs=["post-sitemap.xml", "post_sitemap_1.xml", "post_sitemap_2.xml", "post_sitemap_3.xml", "post-sitemap1.xml", "post-sitemap2.xml", "post-sitemap3.xml"],
+                       cache_dir="sitemap_cache",
+                       max_workers=32,
+                       per_host=4):
+    """
+    Incremental re-crawl : unchanged sitemaps (304) are read from the local snapshot in cache_dir,
+    only the ones that changed are downloaded and parsed again.
+    :return: (full dataframe, delta dataframe) see sitemap_delta for the delta columns
+    """
+    cache = SitemapCache(cache_dir)
+    sitemap_urls = build_sitemap_urls(list_of_sites, list(set(slugs)))
+    previous_df = pd.DataFrame(list(cache.snapshot(sitemap_urls)), columns=["url", "last_modified"])
+    current_df = get_sitemaps(list_of_sites, slugs, max_workers=max_workers, per_host=per_host, cache_dir=cache_dir)
+    return current_df, sitemap_delta(previous_df, current_df)
+
+
+def dataset_schemas():
+    """
+    :return: (arrow schema of the rows, hive partitioning schema) of a sitemap dataset
+    """
+    import pyarrow as pa
+
+    dictionary = pa.dictionary(pa.int32(), pa.string())
+    row_schema = pa.schema([("url", pa.string()),
+                            ("last_modified", pa.timestamp("us", tz="UTC")),
+                            ("host", dictionary),
+                            ("sitemap", dictionary),
+                            ("site", pa.string()),
+                            ("crawl_date", pa.date32())])
+    partition_schema = pa.schema([("site", pa.string()), ("crawl_date", pa.date32())])
+    return row_schema, partition_schema
+
+
+def rows_to_table(rows, crawl_date):
+    """
+    arrow table of rows with source, see dataset_schemas.
+    last_modified is parsed as a UTC timestamp (dates without timezone are taken as UTC, invalid ones are null),
+    site is the host of the crawled site so that it makes a readable partition folder name
+    """
+    import pyarrow as pa
+
+    row_schema, _ = dataset_schemas()
+    batch_df = pd.DataFrame(rows, columns=SOURCE_COLUMNS)
+    batch_df["last_modified"] = pd.to_datetime(batch_df["last_modified"], utc=True, errors="coerce", format="ISO8601")
+    batch_df["host"] = batch_df["url"].map(lambda url: urlparse(url).netloc)
+    batch_df["site"] = batch_df["site"].map(lambda site: urlparse(site).netloc or site)
+    batch_df["crawl_date"] = crawl_date
+    return pa.Table.from_pandas(batch_df, schema=row_schema, preserve_index=False)
+
+
+def write_sitemaps_dataset(rows, dataset_dir, crawl_date=None, mode="append", batch_rows=500000):
+    """
+    Write sitemap rows to a parquet dataset partitioned by site and crawl date (hive folders
+    dataset_dir/site=www.example.com/crawl_date=2024-01-31/), host and sitemap are dictionary encoded.
+    :param rows: iterable of row dicts with source, see iter_sitemaps(with_source=True), written by batch_rows
+    :param crawl_date: datetime.date of the crawl, default today
+    :param mode: "append" adds files to the partitions, "overwrite" replaces the partitions written to
+    :return: number of rows written
+    """
+    import pyarrow.dataset as ds
+
+    _, partition_schema = dataset_schemas()
+    crawl_date = crawl_date or datetime.date.today()
+    # unique file names so that every run appends instead of overwriting the files of the previous one
+    token = uuid.uuid4().hex
+    written = 0
+    batch = []
+
+    def write(batch, batch_number):
+        ds.write_dataset(rows_to_table(batch, crawl_date),
+                         dataset_dir,
+                         format="parquet",
+                         partitioning=ds.partitioning(partition_schema, flavor="hive"),
+                         basename_template=f"{token}-{batch_number}-{{i}}.parquet",
+                         existing_data_behavior="overwrite_or_ignore")
+
+    batch_number = 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_rows:
+            write(batch, batch_number)
+            written += len(batch)
+            batch_number += 1
+            batch = []
+    if batch or batch_number == 0:
+        write(batch, batch_number)
+        written += len(batch)
+    if mode == "overwrite":
+        # the previous files of the partitions written by this run are only dropped once it is complete
+        for folder, _, filenames in os.walk(dataset_dir):
+            if any(filename.startswith(token) for filename in filenames):
+                for filename in filenames:
+                    if not filename.startswith(token):
+                        os.remove(os.path.join(folder, filename))
+    instrumentation.add("rows", written)
+    return written
+
+
+@instrumentation.instrumented(kind="network")
+def export_sitemaps(list_of_sites=[],
+                    dataset_dir="sitemaps_dataset",
+                    slugs=["post-sitemap.xml", "post_sitemap_1.xml", "post_sitemap_2.xml", "post_sitemap_3.xml", "post-sitemap1.xml", "post-sitemap2.xml", "post-sitemap3.xml"],
+                    max_workers=32,
+                    per_host=4,
+                    cache_dir=None,
+                    crawl_date=None,
+                    mode="append"):
+    """
+    Crawl the sitemaps like get_sitemaps and stream the rows into a parquet dataset instead of a dataframe,
+    see write_sitemaps_dataset
+    :return: number of rows written
+    """
+    cache = SitemapCache(cache_dir) if cache_dir else None
+    rows = iter_sitemaps(list_of_sites, slugs, max_workers=max_workers, per_host=per_host, cache=cache,
+                         with_source=True)
+    return write_sitemaps_dataset(rows, dataset_dir, crawl_date=crawl_date, mode=mode)
+
+
+def read_sitemaps_dataset(dataset_dir="sitemaps_dataset", sites=None, since=None, until=None, modified_since=None,
+                          columns=None):
+    """
+    Read a sitemap dataset, the filters on site and crawl date only open the matching partitions
+    :param sites: optional list of sites (urls or hosts)
+    :param since / until: optional datetime.date bounds of the crawl dates, both included
+    :param modified_since: optional timestamp, keeps the rows with a later last_modified
+    :return: dataframe, host / sitemap / site as categoricals
+    """
+    import pyarrow.dataset as ds
+
+    _, partition_schema = dataset_schemas()
+    dataset = ds.dataset(dataset_dir, format="parquet", partitioning=ds.partitioning(partition_schema, flavor="hive"))
+    filters = []
+    if sites is not None:
+        filters.append(ds.field("site").isin([urlparse(site).netloc or site for site in sites]))
+    if since is not None:
+        filters.append(ds.field("crawl_date") >= since)
+    if until is not None:
+        filters.append(ds.field("crawl_date") <= until)
+    if modified_since is not None:
+        modified_since = pd.Timestamp(modified_since)
+        if modified_since.tzinfo is None:
+            modified_since = modified_since.tz_localize("UTC")
+        filters.append(ds.field("last_modified") >= modified_since)
+    expression = None
+    for condition in filters:
+        expression = condition if expression is None else expression & condition
+    table = dataset.to_table(columns=columns, filter=expression)
+    sitemaps_df = table.to_pandas()
+    if "site" in sitemaps_df:
+        sitemaps_df["site"] = sitemaps_df["site"].astype("category")
+    return sitemaps_df
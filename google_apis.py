@@ -1,15 +1,242 @@
 import os
 import json
+import datetime
+import hashlib
+import time
+import random
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import oauth2client.client
 from oauth2client.client import OAuth2WebServerFlow
 import requests_oauthlib
 import httplib2
 import apiclient
+from apiclient.errors import HttpError
 import webbrowser
 from requests_oauthlib import OAuth2Session
+import instrumentation
 from oauth2client import file
 
+SEARCH_CONSOLE_MAX_ROWS = 25000
+REPORTING_MAX_REQUESTS = 5
+REPORTING_BATCH_KEYS = ("viewId", "dateRanges", "segments", "samplingLevel", "cohortGroup")
+REPORTING_METRIC_TYPES = {"INTEGER": "Int64",
+                          "FLOAT": "float64",
+                          "CURRENCY": "float64",
+                          "PERCENT": "float64",
+                          "TIME": "float64"}
+
+
+DEFAULT_QUOTAS = {"analyticsreporting": {"qps": 10, "per_day": 50000},
+                  "webmasters": {"qps": 20, "per_day": None}}
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+RETRYABLE_REASONS = ['HttpError 429', 'userRateLimitExceeded', 'rateLimitExceeded', 'quotaExceeded',
+                     'internalServerError', 'backendError', 'Too Many Requests', 'RATE_LIMIT_EXCEEDED']
+
+
+class TokenBucket(object):
+    """
+    rate tokens per second refill the bucket, up to capacity tokens.
+    acquire blocks until a token is available.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._condition = threading.Condition()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        with self._condition:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                self._condition.wait((1 - self.tokens) / self.rate)
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class DailyQuota(object):
+    """
+    count of the calls of the current UTC day, persisted to state_file so that restarts don't get the whole
+    quota again. acquire raises QuotaExceeded once per_day calls were made, a warning is printed at warn_ratio.
+    """
+
+    def __init__(self, per_day, state_file, warn_ratio=0.9):
+        self.per_day = per_day
+        self.state_file = state_file
+        self.warn_ratio = warn_ratio
+        self._lock = threading.Lock()
+        self.day, self.count = self.load()
+
+    @staticmethod
+    def today():
+        return datetime.datetime.now(datetime.timezone.utc).date().isoformat()
+
+    def load(self):
+        try:
+            with open(self.state_file, 'r') as state:
+                saved = json.load(state)
+            if saved["day"] == self.today():
+                return saved["day"], saved["count"]
+        except (OSError, ValueError, KeyError):
+            pass
+        return self.today(), 0
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.state_file) or ".", exist_ok=True)
+        tmp_path = self.state_file + ".tmp"
+        with open(tmp_path, 'w') as state:
+            json.dump({"day": self.day, "count": self.count}, state)
+        os.replace(tmp_path, self.state_file)
+
+    def acquire(self):
+        with self._lock:
+            today = self.today()
+            if today != self.day:
+                self.day, self.count = today, 0
+            if self.count >= self.per_day:
+                raise QuotaExceeded(f"daily quota of {self.per_day} calls used for {self.day} (UTC), "
+                                    f"it resets at midnight UTC, see {self.state_file}")
+            self.count += 1
+            self.save()
+            if self.count == int(self.per_day * self.warn_ratio):
+                print(f"{self.count} of the {self.per_day} calls of the daily quota used")
+
+    def remaining(self):
+        with self._lock:
+            return self.per_day - self.count if self.day == self.today() else self.per_day
+
+
+class RateLimiter(object):
+    """
+    Quota aware limiter shared by every client of the same project and API.
+    args:
+    qps: max queries per second, the effective rate is lowered after throttling and
+    recovers progressively (additive increase / multiplicative decrease) as calls succeed
+    per_day: optional daily quota, counted per UTC day in quota_file (see DailyQuota), QuotaExceeded is raised
+    once it is used
+    quota_file: json file where the calls of the day are counted, default .quota/daily.json in the cwd
+    max_retries: attempts on throttling / backend errors, Retry-After is honored when sent
+
+    methods:
+    execute: run a googleapiclient request through the limiter
+    metrics: live snapshot of queued, in flight and throttled calls
+    """
+
+    def __init__(self, qps=10, per_day=None, max_retries=5, quota_file=None):
+        self.qps = qps
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(rate=qps, capacity=max(qps, 1))
+        quota_file = quota_file or os.path.join(os.getcwd(), ".quota", "daily.json")
+        self.daily_quota = DailyQuota(per_day, quota_file) if per_day else None
+        self._lock = threading.Lock()
+        self._metrics = {"queued": 0, "in_flight": 0, "calls": 0, "throttled": 0, "retries": 0, "failures": 0}
+
+    def _count(self, name, increment=1):
+        with self._lock:
+            self._metrics[name] += increment
+
+    def metrics(self):
+        with self._lock:
+            return dict(self._metrics, rate=self.bucket.rate)
+
+    def _slow_down(self):
+        with self.bucket._condition:
+            self.bucket.rate = max(self.bucket.rate / 2, 0.1)
+
+    def _speed_up(self):
+        with self.bucket._condition:
+            self.bucket.rate = min(self.bucket.rate + self.qps / 20, self.qps)
+
+    def retry_delay(self, error, attempt):
+        """
+        delay before the next attempt : Retry-After header if the API sent one, exponential backoff otherwise
+        """
+        retry_after = error.resp.get('retry-after') if hasattr(error.resp, 'get') else None
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            return (2 ** attempt) + random.random()
+
+    @staticmethod
+    def is_retryable(error):
+        """
+        retry the transient statuses and the rate limit errors, which google returns as a 403 with the
+        reason in the error details (resp.reason is only the http reason phrase, ie: Forbidden)
+        """
+        if error.resp.status in RETRYABLE_STATUSES:
+            return True
+        details = getattr(error, "error_details", None)
+        if not isinstance(details, list):
+            return False
+        return any(isinstance(detail, dict) and detail.get("reason") in RETRYABLE_REASONS for detail in details)
+
+    def execute(self, request):
+        for attempt in range(self.max_retries):
+            self._count("queued")
+            try:
+                if self.daily_quota is not None:
+                    self.daily_quota.acquire()
+                self.bucket.acquire()
+            finally:
+                self._count("queued", -1)
+
+            self._count("in_flight")
+            instrumentation.add("requests")
+            try:
+                response = request.execute()
+            except HttpError as error:
+                if not self.is_retryable(error) or attempt == self.max_retries - 1:
+                    self._count("failures")
+                    raise
+                self._count("throttled")
+                self._count("retries")
+                instrumentation.add("retries")
+                self._slow_down()
+                print(error.resp.reason)
+                delay = self.retry_delay(error, attempt)
+            else:
+                self._count("calls")
+                self._speed_up()
+                return response
+            finally:
+                self._count("in_flight", -1)
+            time.sleep(delay)
+
+
+LIMITERS = {}
+LIMITERS_LOCK = threading.Lock()
+
+
+def get_limiter(project_id, api_name, qps=None, per_day=None, quota_dir=None):
+    """
+    limiters are shared per (project, api) so that every client of a same project draws from the same quota,
+    the calls of the day are counted in quota_dir (default .quota in the cwd) per project and api
+    """
+    quota = DEFAULT_QUOTAS.get(api_name, {"qps": 10, "per_day": None})
+    with LIMITERS_LOCK:
+        key = (project_id, api_name)
+        if key not in LIMITERS:
+            project_hash = hashlib.sha1(str(project_id).encode("utf-8")).hexdigest()[:12]
+            quota_dir = quota_dir or os.path.join(os.getcwd(), ".quota")
+            quota_file = os.path.join(quota_dir, f"{project_hash}.{api_name}.json")
+            LIMITERS[key] = RateLimiter(qps=qps or quota["qps"], per_day=per_day or quota["per_day"],
+                                        quota_file=quota_file)
+        return LIMITERS[key]
+
 
 class GoogleAPI(object):
 
@@ -21,23 +248,36 @@ class GoogleAPI(object):
     scope: scope of the API telling what you can/can't access. So far all implemented methods are for readonly access
     client_secret_json_file is the fullpath (localepath/filename) where your credentials are stored. You can get them in the google API console
     redirect uri is where you get redirected if your token is missing/invalid.
+    discovery_cache_dir: folder where the discovery documents are cached, default .discovery_cache in the cwd
+    qps / per_day: quota of the API, every client of the same project and API shares one RateLimiter
 
     methods:
     to get / set attribute use the methods get_{attribute_name}()/set_{attribute_name}()
     get_service:
-    create a service object used by all GA apis,
+    create a service object used by all GA apis, built from the cached discovery document and credentials
+    thread_service:
+    service object of the current thread, use it from worker threads
+    execute:
+    run a request through the shared rate limiter, all API calls should go through it
     rule of thumb with filepath : always use full path stuff with os.path.join & os.getcwd()
     To be explicit / and be crossplatform rather than hardcoded strings if you can avoid it
 
     """
 
-    def __init__(self, api_name, api_version, dat_filename, scope, client_secret_json_file, redirect_uri):
+    def __init__(self, api_name, api_version, dat_filename, scope, client_secret_json_file, redirect_uri,
+                 discovery_cache_dir=None, qps=None, per_day=None):
         self.api_name = api_name
         self.api_version = api_version
         self.dat_filename = dat_filename
         self.scope = scope
         self.json_file = client_secret_json_file
         self.redirect_uri = redirect_uri
+        self.discovery_cache_dir = discovery_cache_dir or os.path.join(os.getcwd(), ".discovery_cache")
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._credentials = None
+        self._discovery_document = None
+        self.limiter = get_limiter(self.get_project_id(), api_name, qps=qps, per_day=per_day)
         self.service = self.get_service()
 
     def set_api_name(self, api_name):
@@ -113,48 +353,228 @@ class GoogleAPI(object):
         else:
             return credentials
 
+    def get_project_id(self):
+        try:
+            with open(self.json_file, 'r') as client_secret:
+                return json.load(client_secret)["installed"].get("project_id", self.json_file)
+        except (OSError, ValueError, KeyError):
+            return self.json_file
+
+    @instrumentation.instrumented(kind="network")
+    def execute(self, request):
+        """
+        execute a googleapiclient request within the quota of the API
+        """
+        return self.limiter.execute(request)
+
+    def load_credentials(self):
+        """
+        credentials are read once per object and shared by every service object built afterward
+        """
+        with self._lock:
+            if self._credentials is None:
+                self._credentials = self.get_credentials()
+            return self._credentials
+
+    def discovery_document(self, max_age=7 * 24 * 3600):
+        """
+        discovery document of the API, read from discovery_cache_dir and only downloaded
+        when missing or older than max_age seconds
+        return:discovery document as a json string
+        """
+        with self._lock:
+            if self._discovery_document is not None:
+                return self._discovery_document
+
+            cache_path = os.path.join(self.discovery_cache_dir, f"{self.api_name}.{self.api_version}.json")
+            if os.path.exists(cache_path) and time.time() - os.path.getmtime(cache_path) < max_age:
+                with open(cache_path, 'r', encoding='utf-8') as cached:
+                    self._discovery_document = cached.read()
+                return self._discovery_document
+
+            document = None
+            http = httplib2.Http(timeout=30)
+            for discovery_uri in (apiclient.discovery.DISCOVERY_URI, apiclient.discovery.V2_DISCOVERY_URI):
+                uri = discovery_uri.format(api=self.api_name, apiVersion=self.api_version)
+                try:
+                    response, content = http.request(uri)
+                except (httplib2.HttpLib2Error, OSError) as error:
+                    print(uri, error)
+                    break
+                if response.status < 400:
+                    document = content.decode('utf-8')
+                    break
+
+            if document is None:
+                # offline fallback : the discovery documents shipped with google-api-python-client
+                from googleapiclient import discovery_cache
+                document = discovery_cache.get_static_doc(self.api_name, self.api_version)
+                if document is None:
+                    raise ValueError(f"no discovery document found for {self.api_name} {self.api_version}")
+
+            os.makedirs(self.discovery_cache_dir, exist_ok=True)
+            tmp_path = cache_path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as cached:
+                cached.write(document)
+            os.replace(tmp_path, cache_path)
+            self._discovery_document = document
+            return document
+
     def get_service(self):
-        credentials = self.get_credentials()
+        credentials = self.load_credentials()
         http = httplib2.Http()
         http = credentials.authorize(http)
-        service = apiclient.discovery.build(self.api_name,
-                                            self.api_version,
-                                            http=http)
+        service = apiclient.discovery.build_from_document(self.discovery_document(),
+                                                          http=http)
         print(f"getting {self.api_name} service object")
         return service
 
+    def thread_service(self):
+        """
+        httplib2 objects can't be shared between threads, each worker thread gets its own service object.
+        They are cheap to build as credentials and discovery document are shared.
+        """
+        if threading.current_thread() is threading.main_thread():
+            return self.service
+        if not hasattr(self._local, "service"):
+            self._local.service = self.get_service()
+        return self._local.service
+
 
 class Analytics(GoogleAPI):
     """full core reporting documentation is here :\n
     https://developers.google.com/analytics/devguides/reporting/core/v4/
     """
 
+    def execute_batch(self, report_requests):
+        """
+        run a single batchGet, throttling and retries are handled by the rate limiter
+        return:raw response or None on critical failure
+        """
+        analytics = self.thread_service()
+
+        try:
+            return self.execute(analytics.reports().batchGet(
+                body={
+                    'reportRequests': report_requests
+                }
+            ))
+        except (HttpError) as error:
+            print("Will need to try some other time, critical failure !")
+            print(error.resp.reason)
+
     def get_report(self, query):
         """
         Since the requests can be tedious to put together instead it is requesting core elements.
         Not excluding to refactor the way things are handled later on though
+        return: raw response of the first page, use get_reports to get every page as a dataframe
 
         """
-        analytics = self.service
+        return self.execute_batch([query])
 
-        for n in range(0, 5):
-            try:
-                return analytics.reports().batchGet(
-                    body={
-                        'reportRequests': [
-                            query
-                        ]
-                    }
-                ).execute()
-            except (HttpError) as error:
-                if error.resp.reason in ['HttpError 429', 'userRateLimitExceeded', 'quotaExceeded',
-                                         'internalServerError', 'backendError', 'Too Many Requests']:
-                    time.sleep((2 ** n) + random.random())
-                    print(error.resp.reason)
-                else:
-                    print("Will need to try some other time, critical failure !")
-                    print(error.resp.reason)
-                    break
+    def get_reports(self, queries, max_workers=4, store=None):
+        """
+        Fetch every page of several report requests.
+        Requests sharing the same view, date ranges, segments and sampling level are packed by 5
+        (the API limit) in a single batchGet, nextPageToken is followed for every report
+        and independent batches run concurrently.
+        param:queries: list of reportRequest dicts
+        param:max_workers: number of batches run at the same time
+        param:store: optional ReportStore, the reports are then served by get_report_stored
+        return: list of dataframes, one per query in the same order, None when a batch failed
+        """
+        if store is not None:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                return list(executor.map(lambda query: self.get_report_stored(query, store), queries))
+
+        groups = defaultdict(list)
+        for position, query in enumerate(queries):
+            groups[batch_key(query)].append(position)
+        batches = [positions[i:i + REPORTING_MAX_REQUESTS]
+                   for positions in groups.values()
+                   for i in range(0, len(positions), REPORTING_MAX_REQUESTS)]
+
+        def run_batch(positions):
+            pending = {position: queries[position] for position in positions}
+            pages = {position: [] for position in positions}
+            while pending:
+                order = list(pending)
+                response = self.execute_batch([pending[position] for position in order])
+                if response is None:
+                    return {position: None for position in positions}
+                pending = {}
+                for position, report in zip(order, response.get('reports', [])):
+                    pages[position].append(report_to_df(report))
+                    if report.get('nextPageToken'):
+                        # pages of the same batch stay packed together, they share the batch key
+                        pending[position] = dict(queries[position], pageToken=report['nextPageToken'])
+            return {position: pd.concat(frames, ignore_index=True) for position, frames in pages.items()}
+
+        reports = [None] * len(queries)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for batch_reports in executor.map(run_batch, batches):
+                for position, report_df in batch_reports.items():
+                    reports[position] = report_df
+        return reports
+
+    def get_report_stored(self, query, store):
+        """
+        every page of a report request, the days already in store are read from disk and only the missing
+        or volatile days are requested.
+        The query must have a single date range of YYYY-MM-DD dates, ga:date is added to its dimensions when missing
+        so the rows come per day.
+        return: dataframe or None on critical failure
+        """
+        date_ranges = query.get('dateRanges', [])
+        if len(date_ranges) != 1:
+            raise ValueError("a stored report needs a single date range")
+        if 'ga:date' not in [dimension['name'] for dimension in query.get('dimensions', [])]:
+            query = dict(query, dimensions=[{'name': 'ga:date'}] + query.get('dimensions', []))
+        key = store.key(["analytics", query.get('viewId')], query, ignore=('dateRanges', 'pageToken'))
+
+        def fetch(start_date, end_date):
+            report_df = self.get_reports([dict(query, dateRanges=[{'startDate': start_date, 'endDate': end_date}])])[0]
+            if report_df is None:
+                raise RuntimeError(f"batchGet failed for {start_date} - {end_date}")
+            return report_df
+
+        try:
+            return store.load(key, date_ranges[0]['startDate'], date_ranges[0]['endDate'], fetch,
+                              'ga:date', date_format="%Y%m%d")
+        except RuntimeError as error:
+            print(error)
+
+
+def batch_key(query):
+    """
+    reportRequests of a same batchGet must share these fields
+    """
+    return json.dumps({key: query.get(key) for key in REPORTING_BATCH_KEYS}, sort_keys=True)
+
+
+def report_to_df(report):
+    """
+    convert a core reporting report (columnHeader / data.rows) into a typed dataframe,
+    one column per dimension and one per metric and date range (suffixed with _{n} past the first date range)
+    """
+    column_header = report.get('columnHeader', {})
+    dimensions = column_header.get('dimensions', [])
+    metric_entries = column_header.get('metricHeader', {}).get('metricHeaderEntries', [])
+    rows = report.get('data', {}).get('rows', [])
+
+    date_ranges = max([len(row.get('metrics', [])) for row in rows] + [1])
+    metric_columns = []
+    for n in range(date_ranges):
+        suffix = "" if n == 0 else f"_{n}"
+        metric_columns.extend((entry['name'] + suffix, entry.get('type', 'FLOAT')) for entry in metric_entries)
+
+    records = [row.get('dimensions', []) +
+               [value for date_range in row.get('metrics', []) for value in date_range.get('values', [])]
+               for row in rows]
+    report_df = pd.DataFrame(records, columns=dimensions + [name for name, _ in metric_columns])
+    for name, metric_type in metric_columns:
+        report_df[name] = pd.to_numeric(report_df[name], errors="coerce").astype(REPORTING_METRIC_TYPES.get(metric_type, "float64"))
+    return report_df
 
 
 class SearchConsole(GoogleAPI):
@@ -174,7 +594,7 @@ class SearchConsole(GoogleAPI):
         return: raw response or response in DF
 
         """
-        properties = self.service.sites().list().execute()
+        properties = self.execute(self.service.sites().list())
 
         if to_df:
             return pd.DataFrame(properties['siteEntry'])
@@ -191,36 +611,230 @@ class SearchConsole(GoogleAPI):
           An array of response rows.
         """
 
-        return self.service.searchanalytics().query(
-            siteUrl=property_uri, body=request).execute()
+        return self.execute(self.thread_service().searchanalytics().query(
+            siteUrl=property_uri, body=request))
 
-    def search_analytics_to_df(self, property_uri, request):
+    def search_analytics_pages(self, property_uri, request, max_rows=None):
+        """
+        Page through a searchAnalytics.query with startRow until the API runs out of rows.
+        param:request : original request, its rowLimit is used as the page size (max 25000)
+        param:max_rows : optional cap on the total number of rows fetched
+        return: generator of lists of rows
+        """
+        page_size = min(request.get("rowLimit", SEARCH_CONSOLE_MAX_ROWS), SEARCH_CONSOLE_MAX_ROWS)
+        start_row = request.get("startRow", 0)
+        fetched = 0
+        while max_rows is None or fetched < max_rows:
+            page_request = dict(request, rowLimit=page_size, startRow=start_row)
+            rows = self.search_analytics_data(property_uri, page_request).get("rows", [])
+            if max_rows is not None:
+                rows = rows[:max_rows - fetched]
+            if rows:
+                yield rows
+            fetched += len(rows)
+            start_row += page_size
+            if len(rows) < page_size:
+                break
+
+    def search_analytics_to_df(self, property_uri, request, shard=None, max_workers=4, max_rows=None, store=None):
         """
         You only have to use
-        param:request : original request for the search console
+        param:request : original request for the search console, every page is fetched
+        param:shard : None, "day" or "week", splits the date range of the request into shards fetched concurrently.
+        Without the date dimension in the request, rows are aggregated per shard and the shard dates are added as columns.
+        param:max_workers : number of shards fetched at the same time
+        param:max_rows : optional cap on the number of rows per shard
+        param:store : optional ReportStore, see search_analytics_stored
         return:dataframe if the response is not empty
 
         """
-        response = self.searchanalytics_data(property_uri, request)
+        if store is not None:
+            return self.search_analytics_stored(property_uri, request, store, shard=shard, max_workers=max_workers)
+        dimensions = request.get('dimensions', [])
+
+        def fetch(shard_request):
+            frames = [rows_to_df(rows, dimensions)
+                      for rows in self.search_analytics_pages(property_uri, shard_request, max_rows=max_rows)]
+            if not frames:
+                return None
+            shard_df = pd.concat(frames, ignore_index=True)
+            if shard and "date" not in dimensions:
+                shard_df["shard_start_date"] = shard_request["startDate"]
+                shard_df["shard_end_date"] = shard_request["endDate"]
+            return shard_df
+
+        if shard:
+            shard_requests = [dict(request, startDate=start_date, endDate=end_date)
+                              for start_date, end_date in date_shards(request['startDate'], request['endDate'], shard)]
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                shard_dfs = list(executor.map(fetch, shard_requests))
+        else:
+            shard_dfs = [fetch(request)]
 
-        if 'rows' not in response:
+        shard_dfs = [shard_df for shard_df in shard_dfs if shard_df is not None]
+        if not shard_dfs:
             print('Empty response')
             return None
-        else:
+        return pd.concat(shard_dfs, ignore_index=True)
 
-            data = response['rows']
-            data_df = pd.DataFrame(data)
+    def search_analytics_stored(self, property_uri, request, store, shard=None, max_workers=4):
+        """
+        search_analytics_to_df with the days already in store read from disk, only the missing or volatile days
+        are requested. The date dimension is added to the request when missing so the rows come per day.
+        return:dataframe if the response is not empty
+        """
+        if 'date' not in request.get('dimensions', []):
+            request = dict(request, dimensions=['date'] + request.get('dimensions', []))
+        key = store.key(["searchconsole", property_uri], request, ignore=('startDate', 'endDate', 'startRow'))
 
-            df_dimensions = pd.DataFrame(data_df['keys'].values.tolist(),
-                                         columns=request['dimensions'])
+        def fetch(start_date, end_date):
+            return self.search_analytics_to_df(property_uri, dict(request, startDate=start_date, endDate=end_date),
+                                               shard=shard, max_workers=max_workers)
 
-            response_df = pd.concat([df_dimensions,
-                                     data_df],
-                                    axis=1)
+        stored_df = store.load(key, request['startDate'], request['endDate'], fetch, 'date')
+        if stored_df is None:
+            print('Empty response')
+        return stored_df
+
+
+def rows_to_df(rows, dimensions):
+    """
+    turn search analytics rows into a dataframe with one column per dimension
+    """
+    data_df = pd.DataFrame(rows)
+    df_dimensions = pd.DataFrame(data_df['keys'].values.tolist(),
+                                 columns=dimensions)
+    response_df = pd.concat([df_dimensions,
+                             data_df.drop("keys", axis=1)],
+                            axis=1)
+    return response_df
+
+
+def date_shards(start_date, end_date, shard="day"):
+    """
+    split a date range into consecutive shards
+    param:start_date / end_date : YYYY-MM-DD strings, both included
+    param:shard : "day" or "week"
+    return:list of (start_date, end_date) strings
+    """
+    step = {"day": 1, "week": 7}[shard]
+    start = datetime.date.fromisoformat(start_date)
+    end = datetime.date.fromisoformat(end_date)
+    shards = []
+    while start <= end:
+        shard_end = min(start + datetime.timedelta(days=step - 1), end)
+        shards.append((start.isoformat(), shard_end.isoformat()))
+        start = shard_end + datetime.timedelta(days=1)
+    return shards
+
+
+class ReportStore(object):
+    """
+    On disk store of report rows partitioned by day, repeated queries only fetch the days missing from the store
+    or fetched while still volatile (the last days of Search Console and Analytics data keep changing).
+    store_dir/{key}/{YYYY-MM-DD}.parquet : rows of a day, days without rows have no file
+    store_dir/{key}/partitions.json : days fetched with their row count and fetch time
+    key : hash of the request without its dates and paging, plus the property or view (see ReportStore.key)
+    volatile_days : a day is final once fetched at least volatile_days after it, until then it is fetched again
+    """
+
+    def __init__(self, store_dir="report_store", volatile_days=3):
+        self.store_dir = store_dir
+        self.volatile_days = volatile_days
+        self._lock = threading.Lock()
+        self._key_locks = defaultdict(threading.Lock)
 
-            response_df.drop("keys", axis=1, inplace=True)
+    @staticmethod
+    def key(scope, request, ignore=()):
+        """
+        canonical hash of the request (keys sorted, ignore fields dropped) and of its scope (api, property/view)
+        """
+        body = {field: value for field, value in request.items() if field not in ignore}
+        return hashlib.sha1(json.dumps([scope, body], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def key_lock(self, key):
+        with self._lock:
+            return self._key_locks[key]
 
-            return response_df
+    def partitions(self, key):
+        """
+        return:dict of day -> {"rows", "fetched_at"} already in the store
+        """
+        try:
+            with open(os.path.join(self.store_dir, key, "partitions.json"), "r") as partitions_file:
+                return json.load(partitions_file)
+        except (OSError, ValueError):
+            return {}
+
+    def write_partitions(self, key, partitions):
+        path = os.path.join(self.store_dir, key, "partitions.json")
+        with open(path + ".tmp", "w") as partitions_file:
+            json.dump(partitions, partitions_file, indent=1, sort_keys=True)
+        os.replace(path + ".tmp", path)
+
+    def is_final(self, day, partition):
+        fetched_at = datetime.datetime.fromisoformat(partition["fetched_at"]).date()
+        return (fetched_at - datetime.date.fromisoformat(day)).days >= self.volatile_days
+
+    def missing_ranges(self, partitions, start_date, end_date):
+        """
+        return:list of (start_date, end_date) of consecutive days to fetch
+        """
+        ranges = []
+        for day, _ in date_shards(start_date, end_date, "day"):
+            if day in partitions and self.is_final(day, partitions[day]):
+                continue
+            previous_day = (datetime.date.fromisoformat(day) - datetime.timedelta(days=1)).isoformat()
+            if ranges and ranges[-1][1] == previous_day:
+                ranges[-1] = (ranges[-1][0], day)
+            else:
+                ranges.append((day, day))
+        return ranges
+
+    def store_range(self, key, partitions, start_date, end_date, range_df, date_column, date_format):
+        """
+        split the rows of a fetched range by day and replace the partitions of every day of the range
+        """
+        fetched_at = datetime.datetime.now().isoformat()
+        days = {}
+        if range_df is not None and len(range_df):
+            day_values = pd.to_datetime(range_df[date_column], format=date_format).dt.strftime("%Y-%m-%d")
+            days = {day: day_df for day, day_df in range_df.groupby(day_values, sort=False)}
+
+        for day, _ in date_shards(start_date, end_date, "day"):
+            path = os.path.join(self.store_dir, key, f"{day}.parquet")
+            day_df = days.get(day)
+            if day_df is None:
+                if os.path.exists(path):
+                    os.remove(path)
+            else:
+                day_df.to_parquet(path + ".tmp", index=False)
+                os.replace(path + ".tmp", path)
+            partitions[day] = {"rows": 0 if day_df is None else len(day_df), "fetched_at": fetched_at}
+        self.write_partitions(key, partitions)
+
+    def load(self, key, start_date, end_date, fetch, date_column, date_format="%Y-%m-%d", max_workers=8):
+        """
+        param:fetch : callable(start_date, end_date) -> dataframe of the rows of the range with a date_column, or None
+        when there is no rows, raising on failure (nothing is stored then)
+        param:date_column / date_format : column holding the day of the rows and its format
+        return:dataframe of the rows from start_date to end_date, None if there is no rows
+        """
+        os.makedirs(os.path.join(self.store_dir, key), exist_ok=True)
+        with self.key_lock(key):
+            partitions = self.partitions(key)
+            for range_start, range_end in self.missing_ranges(partitions, start_date, end_date):
+                self.store_range(key, partitions, range_start, range_end, fetch(range_start, range_end),
+                                 date_column, date_format)
+
+            paths = [os.path.join(self.store_dir, key, f"{day}.parquet")
+                     for day, _ in date_shards(start_date, end_date, "day") if partitions[day]["rows"]]
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                frames = list(executor.map(pd.read_parquet, paths))
+        instrumentation.add("stored_rows", sum(len(frame) for frame in frames))
+        if not frames:
+            return None
+        return pd.concat(frames, ignore_index=True)
 
 
 if __name__ == '__main__':
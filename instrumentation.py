@@ -0,0 +1,198 @@
+import contextvars
+import functools
+import json
+import logging
+import threading
+import time
+
+__doc__ = """
+Instrumentation of the network and heavy dataframe helpers.
+Disabled by default: instrumented functions then only pay for one flag check.
+import instrumentation
+counters = instrumentation.CounterExporter()
+instrumentation.enable(counters, instrumentation.JsonLogExporter())
+... run the job ...
+print(counters.snapshot())
+Every instrumented call emits an event with its latency and the metrics recorded during the call
+(requests, bytes, rows, retries...) to every exporter. enable(profile=True) also captures a cProfile
+of the outermost instrumented calls, see profile_stats.
+"""
+
+logger = logging.getLogger(__name__)
+
+
+class _State(object):
+    enabled = False
+    profile = False
+    exporters = []
+    profiles = {}
+    lock = threading.Lock()
+    metrics_lock = threading.Lock()
+
+
+_state = _State()
+# metrics of the instrumented calls in progress, outermost first
+_current_calls = contextvars.ContextVar("instrumented_calls", default=())
+_profiling = contextvars.ContextVar("instrumented_profiling", default=False)
+
+
+class JsonLogExporter(object):
+    """
+    one json line per call, to a logger (default this module logger at INFO level) or to a stream
+    """
+
+    def __init__(self, log=None, stream=None, level=logging.INFO):
+        self.log = log or logger
+        self.stream = stream
+        self.level = level
+
+    def export(self, event):
+        line = json.dumps(event, default=str)
+        if self.stream is not None:
+            self.stream.write(line + "\n")
+        else:
+            self.log.log(self.level, line)
+
+
+class CounterExporter(object):
+    """
+    in process aggregates by function : calls, errors, total/max seconds and the sum of every metric
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def export(self, event):
+        with self._lock:
+            counters = self._counters.setdefault(event["function"], {"calls": 0, "errors": 0,
+                                                                     "seconds": 0.0, "max_seconds": 0.0})
+            counters["calls"] += 1
+            counters["errors"] += event["error"]
+            counters["seconds"] += event["seconds"]
+            counters["max_seconds"] = max(counters["max_seconds"], event["seconds"])
+            for metric, value in event["metrics"].items():
+                counters[metric] = counters.get(metric, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            return {function: dict(counters) for function, counters in self._counters.items()}
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+
+
+def enable(*exporters, profile=False):
+    """
+    start instrumenting, events are sent to exporters (a CounterExporter when none is given)
+    return:list of the exporters
+    """
+    with _state.lock:
+        _state.exporters = list(exporters) or [CounterExporter()]
+        _state.profile = profile
+        _state.enabled = True
+        return _state.exporters
+
+
+def disable():
+    with _state.lock:
+        _state.enabled = False
+        _state.profile = False
+
+
+def is_enabled():
+    return _state.enabled
+
+
+def add(metric, value=1):
+    """
+    add value to a metric (requests, bytes, rows, retries...) of the instrumented calls in progress,
+    the enclosing calls (ie: get_sitemaps around fetch_urls) get it too
+    """
+    if not _state.enabled:
+        return
+    calls = _current_calls.get()
+    if calls:
+        # worker threads of a same call share its metrics
+        with _state.metrics_lock:
+            for metrics in calls:
+                metrics[metric] = metrics.get(metric, 0) + value
+
+
+def profile_stats(function_name):
+    """
+    return:pstats.Stats accumulated over the profiled calls of function_name, None if it never ran profiled
+    """
+    with _state.lock:
+        return _state.profiles.get(function_name)
+
+
+def _store_profile(name, profiler):
+    import pstats
+
+    with _state.lock:
+        if name in _state.profiles:
+            _state.profiles[name].add(profiler)
+        else:
+            _state.profiles[name] = pstats.Stats(profiler)
+
+
+def _emit(event):
+    for exporter in _state.exporters:
+        try:
+            exporter.export(event)
+        except Exception:
+            logger.exception("instrumentation exporter failed")
+
+
+def instrumented(kind="dataframe", rows=None):
+    """
+    decorator recording latency and metrics of each call when instrumentation is enabled
+    kind: "network" or "dataframe", added to the events
+    rows: optional callable(result) -> number of rows processed, added to the rows metric
+    """
+
+    def decorator(function):
+        name = f"{function.__module__}.{function.__qualname__}"
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _state.enabled:
+                return function(*args, **kwargs)
+
+            metrics = {}
+            token = _current_calls.set(_current_calls.get() + (metrics,))
+            profiler = None
+            if _state.profile and not _profiling.get():
+                import cProfile
+
+                profiler = cProfile.Profile()
+            profiling_token = _profiling.set(True) if profiler is not None else None
+            error = False
+            start = time.perf_counter()
+            try:
+                result = profiler.runcall(function, *args, **kwargs) if profiler else function(*args, **kwargs)
+                if rows is not None:
+                    metrics["rows"] = metrics.get("rows", 0) + rows(result)
+                return result
+            except Exception:
+                error = True
+                raise
+            finally:
+                seconds = time.perf_counter() - start
+                _current_calls.reset(token)
+                if profiling_token is not None:
+                    _profiling.reset(profiling_token)
+                if profiler is not None:
+                    _store_profile(name, profiler)
+                _emit({"function": name,
+                       "kind": kind,
+                       "seconds": seconds,
+                       "error": error,
+                       "thread": threading.current_thread().name,
+                       "metrics": metrics})
+
+        return wrapper
+
+    return decorator
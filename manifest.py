@@ -0,0 +1,195 @@
+import functools
+import hashlib
+import json
+import os
+import threading
+
+__doc__ = """
+File manifest of a working folder and resumable pipeline steps built on it.
+import manifest
+files = manifest.Manifest("job_folder")
+
+@files.step(outputs=lambda filename, output_name: [output_name], inputs=lambda filename, output_name: [filename])
+def classify(filename, output_name):
+    ...
+
+classify("crawl.csv", "classified.csv")  # runs
+classify("crawl.csv", "classified.csv")  # skipped : same arguments, crawl.csv and classified.csv unchanged
+A step runs again as soon as one of its inputs or outputs changed (size and mtime, or content hash with
+hash_files=True), one of its outputs is missing or it is called with other arguments.
+"""
+
+HASH_BUFFER_SIZE = 1024 * 1024
+
+
+def file_hash(path, buffer_size=HASH_BUFFER_SIZE):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as hashed:
+        for block in iter(lambda: hashed.read(buffer_size), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class Manifest(object):
+    """
+    Index of the files under root : relative path -> size, mtime and content hash (hashes are only computed
+    with hash_files=True, and again only when the size or mtime of a file changed).
+    The index is built once with a recursive os.scandir and kept up to date by the steps, lookups are dict lookups.
+    It is saved with the records of the completed steps in root/manifest_file.
+    """
+
+    def __init__(self, root=".", manifest_file=".manifest.json", hash_files=False):
+        self.root = root
+        self.path = os.path.join(root, manifest_file)
+        self.hash_files = hash_files
+        self._lock = threading.RLock()
+        saved = self.load()
+        self.files = saved.get("files", {})
+        self.steps = saved.get("steps", {})
+        self.scan()
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as manifest_json:
+                return json.load(manifest_json)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        with self._lock:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as manifest_json:
+                json.dump({"files": self.files, "steps": self.steps}, manifest_json)
+            os.replace(tmp_path, self.path)
+
+    def relative(self, path):
+        return os.path.normpath(os.path.relpath(path, self.root))
+
+    def entry(self, stat, previous=None):
+        entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        if previous and previous["size"] == entry["size"] and previous["mtime_ns"] == entry["mtime_ns"]:
+            entry["hash"] = previous.get("hash")
+        return entry
+
+    def scan(self):
+        """
+        re-index every file under root, the hashes of the files whose size and mtime didn't change are kept
+        """
+        files = {}
+        folders = [self.root]
+        while folders:
+            with os.scandir(folders.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                    elif entry.is_file() and entry.path != self.path:
+                        path = self.relative(entry.path)
+                        files[path] = self.entry(entry.stat(), self.files.get(path))
+        with self._lock:
+            self.files = files
+        return self
+
+    def refresh(self, path):
+        """
+        update the entry of a single file from the disk
+        return:entry, None if the file doesn't exist
+        """
+        relative_path = self.relative(path)
+        with self._lock:
+            try:
+                self.files[relative_path] = self.entry(os.stat(path), self.files.get(relative_path))
+            except OSError:
+                self.files.pop(relative_path, None)
+            return self.files.get(relative_path)
+
+    def __contains__(self, path):
+        return self.relative(path) in self.files
+
+    def get(self, path):
+        return self.files.get(self.relative(path))
+
+    def signature(self, path):
+        """
+        current state of a file : size and content hash with hash_files, size and mtime otherwise,
+        None when it doesn't exist
+        """
+        entry = self.refresh(path)
+        if entry is None:
+            return None
+        if not self.hash_files:
+            return [entry["size"], entry["mtime_ns"]]
+        if entry.get("hash") is None:
+            entry["hash"] = file_hash(path)
+        return [entry["size"], entry["hash"]]
+
+    def signatures(self, paths):
+        return {self.relative(path): self.signature(path) for path in paths}
+
+    @staticmethod
+    def step_key(name, arguments):
+        """
+        key of the record of a call : the step name and a hash of its canonical arguments,
+        so that every call of a step (ie: one per locale or file) is recorded on its own
+        """
+        digest = hashlib.sha1(json.dumps(arguments, sort_keys=True).encode("utf-8")).hexdigest()
+        return f"{name}:{digest}"
+
+    def is_done(self, name, inputs, outputs, arguments):
+        """
+        True when the step already ran with these arguments and none of its inputs or outputs changed since
+        """
+        with self._lock:
+            record = self.steps.get(self.step_key(name, arguments))
+        if record is None or record["arguments"] != arguments:
+            return False
+        output_signatures = self.signatures(outputs)
+        if None in output_signatures.values() or output_signatures != record["outputs"]:
+            return False
+        return self.signatures(inputs) == record["inputs"]
+
+    def record(self, name, inputs, outputs, arguments, result=None):
+        with self._lock:
+            self.steps[self.step_key(name, arguments)] = {"arguments": arguments,
+                                                          "inputs": self.signatures(inputs),
+                                                          "outputs": self.signatures(outputs),
+                                                          "result": result}
+            self.save()
+
+    def result(self, name, arguments):
+        with self._lock:
+            return self.steps.get(self.step_key(name, arguments), {}).get("result")
+
+    def step(self, outputs, inputs=(), name=None):
+        """
+        decorator skipping a step whose inputs, outputs and arguments didn't change since it last completed
+        outputs / inputs: list of file paths or callable(*args, **kwargs) returning it
+        name: name of the step in the manifest, default the name of the function, each set of arguments
+        has its own record
+        The skipped calls return the result recorded by the last run when it could be saved as json, else None.
+        Arguments are compared through their json representation (repr for the other objects),
+        steps should take file names rather than dataframes.
+        """
+
+        def decorator(function):
+            step_name = name or function.__qualname__
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                step_inputs = inputs(*args, **kwargs) if callable(inputs) else list(inputs)
+                step_outputs = outputs(*args, **kwargs) if callable(outputs) else list(outputs)
+                arguments = json.loads(json.dumps([args, kwargs], sort_keys=True, default=repr))
+                if self.is_done(step_name, step_inputs, step_outputs, arguments):
+                    print(step_name, "unchanged, passing")
+                    return self.result(step_name, arguments)
+
+                result = function(*args, **kwargs)
+                try:
+                    recorded = json.loads(json.dumps(result))
+                except (TypeError, ValueError):
+                    recorded = None
+                self.record(step_name, step_inputs, step_outputs, arguments, recorded)
+                return result
+
+            return wrapper
+
+        return decorator
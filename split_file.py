@@ -1,33 +1,235 @@
+import math
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
 import pandas as pd
 
+OUTPUT_FORMATS = ("csv", "parquet", "xlsx")
+# one end of fragment marker put in a writer queue
+END_OF_FRAGMENT = None
+
 
-def split_file(df=None, step=1, output_name=""):
+def iter_datafile_chunks(filename, chunksize=100000, dtype=None):
     """
-    param:df = dataframe to split DataFrame object
-    param:step= number of fragments, default 1
-    output name:string
+    Stream a csv or xlsx file as dataframes of at most chunksize rows
+    so the whole file never has to be held in memory.
+    dtype: optional dtype of every column, dtypes inferred chunk by chunk can differ from one chunk to the next
+    """
+    if filename.endswith(".csv"):
+        yield from pd.read_csv(filename, chunksize=chunksize, dtype=dtype)
+    elif filename.endswith(".xlsx"):
+        import openpyxl
+
+        workbook = openpyxl.load_workbook(filename, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                return
+            batch = []
+            for row in rows:
+                batch.append(row)
+                if len(batch) == chunksize:
+                    yield xlsx_chunk(batch, header, dtype)
+                    batch = []
+            if batch:
+                yield xlsx_chunk(batch, header, dtype)
+        finally:
+            workbook.close()
+    else:
+        raise TypeError("Only xlsx or csv are allowed")
+
+
+def xlsx_chunk(rows, header, dtype=None):
+    chunk = pd.DataFrame(rows, columns=header)
+    if dtype is None:
+        return chunk
+    return chunk.astype(dtype).where(chunk.notna(), None)
+
 
+def iter_dataframe_chunks(df, chunksize=100000):
+    for start in range(0, len(df), chunksize):
+        yield df.iloc[start:start + chunksize]
 
+
+def count_rows(filename, chunksize=1000000):
+    """
+    number of data rows in a csv or xlsx file, without loading it
     """
+    if filename.endswith(".xlsx"):
+        import openpyxl
 
-    len_df = len(data_set_links)
-    print(f" is the original length of the table {len(data_set_links)}")
+        workbook = openpyxl.load_workbook(filename, read_only=True)
+        try:
+            sheet = workbook.active
+            if sheet.max_row:
+                return max(sheet.max_row - 1, 0)
+            return max(sum(1 for _ in sheet.iter_rows(values_only=True)) - 1, 0)
+        finally:
+            workbook.close()
+    return sum(len(chunk) for chunk in pd.read_csv(filename, usecols=[0], chunksize=chunksize))
 
-    fragment_length = int(len_df / step)
-    print(f"{fragment_length} is the length of the fragment")
 
-    for i in range(1, step + 1):
+def write_fragment(chunks, path, output_format):
+    """
+    Writer run by the worker pool: drains the chunks queue into a single fragment file
+    until END_OF_FRAGMENT comes through.
+    return:path and number of rows written
+    """
+    written = 0
+    if output_format == "csv":
+        with open(path, "w", newline="", encoding="utf-8") as output:
+            while (chunk := chunks.get()) is not END_OF_FRAGMENT:
+                chunk.to_csv(output, header=written == 0, index=False)
+                written += len(chunk)
+    elif output_format == "parquet":
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = None
+        try:
+            while (chunk := chunks.get()) is not END_OF_FRAGMENT:
+                if writer is None:
+                    table = pa.Table.from_pandas(chunk, preserve_index=False)
+                    writer = pq.ParquetWriter(path, table.schema)
+                else:
+                    table = pa.Table.from_pandas(chunk, schema=writer.schema, preserve_index=False)
+                writer.write_table(table)
+                written += len(chunk)
+        finally:
+            if writer is not None:
+                writer.close()
+    elif output_format == "xlsx":
+        import openpyxl
+
+        # write only mode streams rows to disk, urls are kept as plain strings
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet()
+        while (chunk := chunks.get()) is not END_OF_FRAGMENT:
+            if written == 0:
+                sheet.append([str(column) for column in chunk.columns])
+            for row in chunk.astype(object).where(chunk.notna(), None).itertuples(index=False, name=None):
+                sheet.append(row)
+            written += len(chunk)
+        workbook.save(path)
+    print(path, written)
+    return path, written
+
+
+def put_chunk(chunks, chunk, fragment):
+    """
+    queue a chunk for a writer, re-raising the writer error instead of blocking forever if it died
+    """
+    while True:
+        try:
+            chunks.put(chunk, timeout=1)
+            return
+        except queue.Full:
+            if fragment.done():
+                fragment.result()
+
 
-        print(i)
-        writer = pd.ExcelWriter(f"{i}_{output_name}.xlsx", options={'strings_to_urls': False})
+def split_chunks(chunks, rows_per_file=None, bytes_per_file=None, output_name="", output_format="csv",
+                 max_workers=4, queue_size=4):
+    """
+    Split a stream of dataframes into fragments written in parallel by a pool of writers.
+    param:chunks = iterable of dataframes
+    param:rows_per_file = max number of rows per fragment
+    param:bytes_per_file = approximate max size of a fragment, rows per file is derived from the
+    csv size of the rows of the first chunk
+    param:output_name = fragments are named {i}_{output_name}.{output_format}, i starting at 1
+    param:output_format = csv, parquet or xlsx
+    param:max_workers = number of fragments being written at the same time
+    param:queue_size = chunks buffered per fragment, bounds the memory used when writers are slower than the reader
+    return:list of fragment paths
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"output_format should be one of {OUTPUT_FORMATS}")
+    if not rows_per_file and not bytes_per_file:
+        raise ValueError("Either rows_per_file or bytes_per_file is needed")
 
-        batch_link_data = df.iloc[(i - 1) * fragment_length:i * fragment_length]
-        print(len(batch_link_data))
-        assert len(batch_link_data) < (fragment_length + 1)
-        batch_link_data.to_excel(writer, index=False)
-        writer.save()
+    fragments = []
+    current = None
+    current_rows = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for chunk in chunks:
+                if not rows_per_file:
+                    sample = chunk.head(1000)
+                    row_bytes = max(len(sample.to_csv(index=False, header=False).encode("utf-8")) / max(len(sample), 1), 1)
+                    rows_per_file = max(int(bytes_per_file // row_bytes), 1)
+                    print(f"{rows_per_file} rows per fragment")
+                start = 0
+                while start < len(chunk):
+                    if current is None:
+                        current = queue.Queue(maxsize=queue_size)
+                        path = f"{len(fragments) + 1}_{output_name}.{output_format}"
+                        fragments.append(executor.submit(write_fragment, current, path, output_format))
+                        current_rows = 0
+                    piece = chunk.iloc[start:start + rows_per_file - current_rows]
+                    put_chunk(current, piece, fragments[-1])
+                    start += len(piece)
+                    current_rows += len(piece)
+                    if current_rows == rows_per_file:
+                        put_chunk(current, END_OF_FRAGMENT, fragments[-1])
+                        current = None
+        finally:
+            # the remainder rows go to a last, smaller fragment
+            if current is not None:
+                put_chunk(current, END_OF_FRAGMENT, fragments[-1])
+        paths = [fragment.result()[0] for fragment in fragments]
     print("Done")
-    return None
+    return paths
+
+
+def split_datafile(filename, step=None, rows_per_file=None, bytes_per_file=None, output_name="",
+                   output_format="csv", chunksize=100000, max_workers=4):
+    """
+    Split a csv or xlsx file without loading it in memory.
+    param:filename = csv or xlsx file to split
+    param:step = number of fragments, the last fragment gets the remainder rows
+    param:rows_per_file / bytes_per_file = alternative ways of sizing the fragments
+    param:output_format = csv, parquet or xlsx, parquet fragments have string columns : the dtypes pandas
+    infers differ from one chunk to the next (ie: int then float) while a parquet file has a single schema
+    return:list of fragment paths
+    """
+    if step:
+        len_df = count_rows(filename)
+        print(f" is the original length of the table {len_df}")
+        rows_per_file = max(math.ceil(len_df / step), 1)
+        print(f"{rows_per_file} is the length of the fragment")
+
+    dtype = str if output_format == "parquet" else None
+    return split_chunks(iter_datafile_chunks(filename, chunksize=chunksize, dtype=dtype),
+                        rows_per_file=rows_per_file,
+                        bytes_per_file=bytes_per_file,
+                        output_name=output_name or os.path.splitext(os.path.basename(filename))[0],
+                        output_format=output_format,
+                        max_workers=max_workers)
+
+
+def split_file(df=None, step=1, output_name="", output_format="xlsx", max_workers=4):
+    """
+    param:df = dataframe to split DataFrame object
+    param:step= number of fragments, default 1, the last fragment gets the remainder rows
+    output name:string
+    output format: csv, parquet or xlsx
+
+
+    """
+
+    len_df = len(df)
+    print(f" is the original length of the table {len_df}")
+
+    fragment_length = max(math.ceil(len_df / step), 1)
+    print(f"{fragment_length} is the length of the fragment")
+
+    return split_chunks(iter_dataframe_chunks(df),
+                        rows_per_file=fragment_length,
+                        output_name=output_name,
+                        output_format=output_format,
+                        max_workers=max_workers)
 
 
 def read_datafile(filename):
@@ -45,6 +247,7 @@ if __name__ == '__main__':
     step will be the number of fragments you are going to have.
     pick your number
     output_name : the name you want for your fragmented file. It will include the fragment number as well
+    output_format : csv, parquet or xlsx
     don't touch the function above unless you know what you are doing
 
 
@@ -54,9 +257,9 @@ if __name__ == '__main__':
 
     step = 1
     output_name = ""
+    output_format = "xlsx"
 
-    file_df = read_datafile(filename)
-
-    split_file(data_set_links=file_df,
-               step=step,
-               output_name=output_name)
+    split_datafile(filename,
+                   step=step,
+                   output_name=output_name,
+                   output_format=output_format)
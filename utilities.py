@@ -1,18 +1,21 @@
 import os
 import re
-import lxml
-import codecs
-from lxml import etree
-import lxml.html as lh
-import xml.etree.ElementTree
+import sys
+import csv
+import json
+import glob
+import queue
+import threading
+import functools
+import importlib
 import time
-import pandas as pd
-import requests
 import uuid
-import tldextract
 import logging
-import plotly.express as px
-from urllib.parse import urlparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import instrumentation
+import manifest
 
 
 __doc__ = """
@@ -20,42 +23,340 @@ This section should be where all diverse utilities are located, for all types of
 #to use this as a custom library you should have this at the top of your scripts :
 import sys
 sys.path.insert(0, "C:\\python_projects\\custom_libraries")
+Heavy dependencies (pandas, plotly, lxml, requests, tldextract...) are only imported
+the first time a function needs them, run this file to report the import cost of each function.
 """
 
 
-def encode_and_bind(original_dataframe, feature_to_encode):
+class LazyModule(object):
+    """
+    Stand-in for a module that is only imported on first attribute access.
+    The import is done under a lock: threads making the first access at the same time all get the loaded module.
+    """
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+        self.__dict__["_lock"] = threading.Lock()
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self.__dict__["_module"] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attribute):
+        return getattr(self.load(), attribute)
+
+    def __repr__(self):
+        return f"<lazy module {self._name!r}{'' if self._module is None else ' (loaded)'}>"
+
+
+np = LazyModule("numpy")
+pd = LazyModule("pandas")
+px = LazyModule("plotly.express")
+lh = LazyModule("lxml.html")
+requests = LazyModule("requests")
+tldextract = LazyModule("tldextract")
+getsitemaps = LazyModule("getsitemaps")
+
+logger = logging.getLogger(__name__)
+
+
+class CategoryEncoder(object):
+    """
+    One hot encoder for several features at once, with a vocabulary fitted once and reused
+    so that later batches get exactly the same columns without re-scanning the data.
+    min_frequency: categories seen less often than this go to the other bucket
+    top_k: only keep the top_k most frequent categories of each feature, the rest goes to the other bucket
+    other: name of the bucket, unseen categories at transform time land in it too
+    when neither min_frequency nor top_k is set there is no bucket and unseen categories are all zeros
+    """
+
+    def __init__(self, min_frequency=None, top_k=None, other="other"):
+        self.min_frequency = min_frequency
+        self.top_k = top_k
+        self.other = other
+        self.vocabulary = {}
+
+    @property
+    def bucketing(self):
+        return self.min_frequency is not None or self.top_k is not None
+
+    def fit(self, df, features):
+        if type(features) == str:
+            features = [features]
+        for feature in features:
+            counts = df[feature].value_counts()
+            if self.min_frequency is not None:
+                counts = counts[counts >= self.min_frequency]
+            if self.top_k is not None:
+                counts = counts.head(self.top_k)
+            self.vocabulary[feature] = sorted(counts.index.tolist(), key=str)
+        return self
+
+    def feature_names(self):
+        names = []
+        for feature, categories in self.vocabulary.items():
+            names.extend(f"{feature}_{category}" for category in categories)
+            if self.bucketing:
+                names.append(f"{feature}_{self.other}")
+        return names
+
+    def transform_matrix(self, df):
+        """
+        return:scipy csr matrix with one column per feature_names()
+        """
+        from scipy import sparse
+
+        rows, columns = [], []
+        offset = 0
+        for feature, categories in self.vocabulary.items():
+            values = df[feature]
+            # codes are int8 for small vocabularies, the offset would overflow them
+            codes = pd.Categorical(values, categories=categories).codes.astype(np.int64)
+            if self.bucketing:
+                # unknown and rare categories go to the bucket, missing values stay all zeros
+                codes = np.where((codes == -1) & values.notna().to_numpy(), len(categories), codes)
+            present = np.flatnonzero(codes != -1)
+            rows.append(present)
+            columns.append(codes[present] + offset)
+            offset += len(categories) + (1 if self.bucketing else 0)
+
+        rows = np.concatenate(rows) if rows else np.empty(0, dtype=int)
+        columns = np.concatenate(columns) if columns else np.empty(0, dtype=int)
+        return sparse.csr_matrix((np.ones(len(rows), dtype="uint8"), (rows, columns)), shape=(len(df), offset))
+
+    def transform(self, df, sparse=True):
+        """
+        return:dataframe of the encoded columns, pandas sparse columns when sparse is True
+        """
+        encoded = pd.DataFrame.sparse.from_spmatrix(self.transform_matrix(df),
+                                                    index=df.index,
+                                                    columns=self.feature_names())
+        return encoded if sparse else encoded.sparse.to_dense()
+
+    def to_dict(self):
+        return {"min_frequency": self.min_frequency,
+                "top_k": self.top_k,
+                "other": self.other,
+                "vocabulary": self.vocabulary}
+
+    @classmethod
+    def from_dict(cls, fitted):
+        encoder = cls(min_frequency=fitted["min_frequency"], top_k=fitted["top_k"], other=fitted["other"])
+        encoder.vocabulary = fitted["vocabulary"]
+        return encoder
+
+
+@instrumentation.instrumented()
+def encode_and_bind(original_dataframe, feature_to_encode, sparse=False, min_frequency=None, top_k=None, encoder=None):
     """
     One hot encode features in a dataframe then drop the encoded feature.
-    feature to encode is a string label
+    feature to encode is a string label or a list of labels
+    sparse: False for dense columns, True for pandas sparse columns, "csr" to get a scipy csr matrix instead
+    min_frequency/top_k: bucket rare categories, see CategoryEncoder
+    encoder: already fitted CategoryEncoder to reuse its vocabulary, the data isn't scanned again,
+    feature_to_encode must then be the features it was fitted on
+    return: dataframe, or (csr matrix, column names) when sparse is "csr"
 
     """
-    dummies = pd.get_dummies(original_dataframe[[feature_to_encode]])
-    res = pd.concat([original_dataframe, dummies], axis=1)
-    res = res.drop([feature_to_encode], axis=1)
+    features = [feature_to_encode] if type(feature_to_encode) == str else list(feature_to_encode)
+    if encoder is None:
+        encoder = CategoryEncoder(min_frequency=min_frequency, top_k=top_k).fit(original_dataframe, features)
+    elif set(features) != set(encoder.vocabulary):
+        raise ValueError(f"encoder was fitted on {list(encoder.vocabulary)}, not on {features}")
+    features = list(encoder.vocabulary)
+
+    if sparse == "csr":
+        return encoder.transform_matrix(original_dataframe), encoder.feature_names()
+
+    dummies = encoder.transform(original_dataframe, sparse=bool(sparse))
+    # bound by position, joining on labels would multiply the rows of duplicated index labels
+    res = pd.concat([original_dataframe.drop(features, axis=1).reset_index(drop=True),
+                     dummies.reset_index(drop=True)], axis=1)
+    res.index = original_dataframe.index
 
     return(res)
 
 
+def count_column(name):
+    """
+    name of the counts of a distribution, "frequency" when the column itself is named count
+    """
+    return "frequency" if name == "count" else "count"
+
+
+def distribution_frame(series, mode="auto", top_n=50, bins=50, max_points=1000):
+    """
+    Aggregate a column before plotting it, so the figure size doesn't depend on the cardinality of the column.
+    mode:
+    top: top_n most frequent values plus an "other" bucket
+    histogram: numeric values binned in bins bins
+    rank: rank/frequency of the values, sampled on a log scale to at most max_points points
+    auto: histogram for numeric columns with more than bins distinct values, top otherwise
+    return:(mode, dataframe of the aggregated distribution), counts are in count_column(series.name)
+    """
+    count = count_column(series.name)
+    if mode == "auto":
+        is_numeric = pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series)
+        mode = "histogram" if is_numeric and series.nunique() > bins else "top"
+
+    if mode == "top":
+        counts = series.value_counts()
+        distribution = counts.head(top_n).rename(count).rename_axis(series.name).reset_index()
+        distribution[series.name] = distribution[series.name].astype(str)
+        other = int(counts.iloc[top_n:].sum())
+        if other:
+            distribution.loc[len(distribution)] = ["other", other]
+    elif mode == "histogram":
+        counts, edges = np.histogram(series.dropna().to_numpy(), bins=bins)
+        distribution = pd.DataFrame({series.name: edges[:-1], count: counts, "bin_end": edges[1:]})
+    elif mode == "rank":
+        counts = series.value_counts().to_numpy()
+        if len(counts):
+            ranks = np.unique(np.geomspace(1, len(counts), num=min(max_points, len(counts))).astype(int))
+        else:
+            # empty or all missing series
+            ranks = np.empty(0, dtype=int)
+        distribution = pd.DataFrame({"rank": ranks, count: counts[ranks - 1]})
+    else:
+        raise ValueError("mode should be one of auto, top, histogram, rank")
+    return mode, distribution
+
+
+def distribution_figure(df=None, column="", mode="auto", top_n=50, bins=50, max_points=1000):
+    mode, distribution = distribution_frame(df[column], mode=mode, top_n=top_n, bins=bins, max_points=max_points)
+    print(column, mode, len(distribution), "points")
+    print(distribution.head(10))
+
+    if mode == "rank":
+        return px.line(distribution, x="rank", y=count_column(column), log_x=True, log_y=True, title=column)
+    return px.bar(distribution, x=column, y=count_column(column), title=column)
+
+
 def view_distrib(df=None,
-                 column=""):
+                 column="",
+                 mode="auto",
+                 top_n=50,
+                 bins=50,
+                 max_points=1000):
     """
     Takes a column return a saved graph to show rough distribution before proceeding to further analysis
+    The column is aggregated before plotting, see distribution_frame for the modes.
+    return:filename of the graph
+
+
+    """
+    fig = distribution_figure(df, column, mode=mode, top_n=top_n, bins=bins, max_points=max_points)
+    filename = f"{column}_distribution.jpeg"
+    fig.write_image(filename)
+
+    return filename
+
+
+def view_distribs(df=None, columns=None, mode="auto", top_n=50, bins=50, max_points=1000):
+    """
+    view_distrib for many columns in one call, all the images are exported by the same renderer process
+    columns: list of columns, default all columns of df
+    return:list of filenames
+    """
+    columns = list(df.columns) if columns is None else columns
+    figures = [distribution_figure(df, column, mode=mode, top_n=top_n, bins=bins, max_points=max_points)
+               for column in columns]
+    filenames = [f"{column}_distribution.jpeg" for column in columns]
+
+    import plotly.io as pio
+
+    if hasattr(pio, "write_images"):
+        pio.write_images(figures, filenames)
+    else:
+        # older plotly/kaleido keep a single kaleido process alive between calls
+        for figure, filename in zip(figures, filenames):
+            figure.write_image(filename)
+    return filenames
 
 
+class ExchangeRates(object):
     """
+    Exchange rate provider fetching a single base currency and deriving every cross rate from it.
+    Rates are cached in memory and in cache_file for ttl seconds.
+    When the API can't be reached, the last cached rates (or snapshot_file) are used whatever their age.
+    base : 3 letters internationally compliant format :
+    https://en.wikipedia.org/wiki/ISO_4217
+    """
+
+    def __init__(self, base="EUR", ttl=6 * 3600, cache_file="exchange_rates.json", snapshot_file=None):
+        self.base = base
+        self.ttl = ttl
+        self.cache_file = cache_file
+        self.snapshot_file = snapshot_file
+        self._rates = None
+        self._fetched_at = 0
+        self._lock = threading.Lock()
+
+    def _read(self, filename):
+        try:
+            with open(filename, "r") as rates_file:
+                cached = json.load(rates_file)
+        except (OSError, ValueError, TypeError):
+            return None
+        if cached.get("base") != self.base:
+            return None
+        return cached
+
+    def _fetch(self):
+        base_target_url = f"https://api.exchangerate-api.com/v4/latest/{self.base}"
+        rates = requests.get(base_target_url, timeout=30).json()["rates"]
+        cached = {"base": self.base, "rates": rates, "fetched_at": time.time()}
+        if self.cache_file:
+            tmp_filename = self.cache_file + ".tmp"
+            with open(tmp_filename, "w") as rates_file:
+                json.dump(cached, rates_file)
+            os.replace(tmp_filename, self.cache_file)
+        return cached
+
+    def rates(self):
+        """
+        return:dict of currency -> number of units for 1 unit of base
+        """
+        with self._lock:
+            if self._rates is not None and time.time() - self._fetched_at < self.ttl:
+                return self._rates
+
+            cached = self._read(self.cache_file) if self.cache_file else None
+            if cached is None or time.time() - cached["fetched_at"] >= self.ttl:
+                try:
+                    cached = self._fetch()
+                except (requests.RequestException, ValueError, KeyError) as error:
+                    cached = cached or self._read(self.snapshot_file)
+                    if cached is None:
+                        raise
+                    print("exchange rates API unavailable, using rates fetched at", time.ctime(cached["fetched_at"]), error)
+                    # stale rates are kept in memory for a ttl rather than hitting the API on every call
+                    cached = dict(cached, fetched_at=time.time())
 
-    df_test = pd.DataFrame(df[column].value_counts())
-    df_test["rank"] = df_test.index
+            self._rates = cached["rates"]
+            self._fetched_at = cached["fetched_at"]
+            return self._rates
 
-    print(df_test)
+    def cross_rates(self, base):
+        """
+        return:dict of currency -> number of units for 1 unit of base, derived from the single base fetch
+        """
+        rates = self.rates()
+        return {currency: rate / rates[base] for currency, rate in rates.items()}
 
-    fig = px.bar(df_test,
-                 x="rank",
-                 y=column
-                 )
-    fig.write_image(f"{column}_distribution.jpeg")
+    def matrix(self):
+        """
+        return:dataframe of every cross rate, matrix.loc[from, to] is the number of "to" for 1 "from"
+        """
+        rates = pd.Series(self.rates(), dtype="float64")
+        return pd.DataFrame(np.outer(1 / rates.to_numpy(), rates.to_numpy()), index=rates.index, columns=rates.index)
 
-    return None
+
+exchange_rates = ExchangeRates()
 
 
 def return_exchange_rates(
@@ -64,13 +365,27 @@ def return_exchange_rates(
     Call Exchange rate where :
     base : 3 letters internationally compliant format :
     https://en.wikipedia.org/wiki/ISO_4217
+    rates are derived from the cached exchange_rates provider
 
     """
-    base_target_url = f"https://api.exchangerate-api.com/v4/latest/{base}"
+    return exchange_rates.cross_rates(base)
 
-    response = requests.get(base_target_url).json()
 
-    return response["rates"]
+@instrumentation.instrumented(rows=len)
+def convert_currency(df, amount_column, currency_column, target="EUR", output_column=None, provider=None):
+    """
+    Convert an amount column expressed in the currencies of currency_column into target, in one vectorized operation.
+    output_column: optional column of df where the converted amounts are also written
+    provider: ExchangeRates, default the module cached one
+    return:Series of converted amounts, unknown currencies give NaN
+    """
+    rates = (provider or exchange_rates).cross_rates(target)
+    # 1 unit of currency = 1 / rates[currency] units of target
+    factors = df[currency_column].astype(str).str.upper().map({currency: 1 / rate for currency, rate in rates.items()})
+    converted = (df[amount_column] * factors.astype("float64")).rename(f"{amount_column}_{target}")
+    if output_column:
+        df[output_column] = converted
+    return converted
 
 
 def get_filetype_cwd(extension=""):
@@ -84,6 +399,8 @@ def get_filetype_cwd(extension=""):
 
 
 def weird_chars():
+    import codecs
+
     sys.stdout = codecs.getwriter("utf-8")(sys.stdout.detach())
 
 
@@ -102,180 +419,1022 @@ def create_folder(directory):
         logger.info('Error: Creating directory. ' + directory)
 
 
+NETLOC_CACHE_SIZE = 2 ** 17
+# a scheme is only taken as such when // follows it, so that example.com:8080 keeps its host
+HOST_PATTERN = re.compile(r"^\s*(?:[a-zA-Z][a-zA-Z0-9+.-]*:(?=//))?(?://)?(?:[^@/?#]*@)?([^:/?#\s]*)")
+
+
+@functools.lru_cache(maxsize=None)
+def offline_tld_extract():
+    """
+    suffix_list_urls=() pins tldextract to the public suffix snapshot shipped with the package:
+    no network call at startup and stable results across runs
+    """
+    return tldextract.TLDExtract(suffix_list_urls=(), cache_dir=None)
+
+
+@functools.lru_cache(maxsize=NETLOC_CACHE_SIZE)
+def split_host(host):
+    """
+    split a hostname with the offline public suffix snapshot, memoized per hostname
+    return:(netloc, registered domain, suffix)
+    """
+    ext = offline_tld_extract()(host)
+    final_subdomain = ".".join([ext.subdomain, ext.domain, ext.suffix]).strip(".")
+    registered_domain = ".".join([ext.domain, ext.suffix]) if ext.domain and ext.suffix else ""
+    return final_subdomain, registered_domain, ext.suffix
+
+
 def netloc(url):
     """
     extract the netloc from url
     """
-    try:
-        ext = tldextract.extract(url)
-    except TypeError:
+    if not isinstance(url, str):
         print(url)
         return "type error"
 
     try:
         # This is because in some cases there is not subdomains.
         # in our case better to be more accurate
-        final_subdomain = '.'.join(ext).strip(".")
-        return final_subdomain
+        return split_host(HOST_PATTERN.match(url).group(1).lower())[0]
     except:
         return "error"
 
 
-def extract_skus(df, columns):
+def url_hosts(urls):
+    """
+    urls: Series of urls
+    return:(codes, lowercased hosts), the host of each url is hosts[code], code -1 for missing or non string urls
+    The host is always before the third "/" of a url: with pyarrow the urls are cut to that prefix and
+    dictionary encoded, so HOST_PATTERN only runs once per distinct prefix (a handful of sites in a crawl)
+    """
+    values = urls.to_numpy(dtype=object)
+    match_host = HOST_PATTERN.match
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+    except ImportError:
+        url_codes, unique_urls = pd.factorize(values)
+        hosts = np.array([match_host(url).group(1) if isinstance(url, str) else None for url in unique_urls],
+                         dtype=object)
+        host_codes, unique_hosts = pd.factorize(hosts)
+        # code -1 (missing url) picks the trailing -1
+        return np.append(host_codes, -1)[url_codes], [host.lower() for host in unique_hosts]
+
+    try:
+        strings = pa.array(values, type=pa.large_string(), from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # numbers and other non string values are missing urls
+        strings = pa.array([url if isinstance(url, str) else None for url in values], type=pa.large_string())
+    prefixes = pc.binary_join(pc.list_slice(pc.split_pattern(strings, "/", max_splits=3), 0, 3),
+                              pa.scalar("/", type=pa.large_string()))
+    encoded = pc.dictionary_encode(prefixes)
+    hosts = [match_host(prefix).group(1).lower() for prefix in encoded.dictionary.to_pylist()]
+    return encoded.indices.fill_null(-1).to_numpy(zero_copy_only=False), hosts
+
+
+@instrumentation.instrumented(rows=len)
+def netlocs(urls, details=False):
+    """
+    batch version of netloc for Series/iterables of urls.
+    The hosts are parsed once per distinct url prefix (see url_hosts), then each goes through tldextract only once.
+    urls:Series or iterable of urls
+    details:bool, also return the registered domain and suffix
+    return:Series of netlocs with the index of urls if it's a Series,
+    or a dataframe of netloc, registered_domain, suffix when details is True
+    missing/non string urls give a missing value
+    """
+    urls = urls if isinstance(urls, pd.Series) else pd.Series(list(urls), dtype=object)
+    codes, hosts = url_hosts(urls)
+    parts = [split_host(host) for host in hosts]
+
+    columns = ["netloc", "registered_domain", "suffix"] if details else ["netloc"]
+    result = pd.DataFrame(index=urls.index)
+    for position, column in enumerate(columns):
+        values = np.array([part[position] for part in parts] + [None], dtype=object)
+        # code -1 (missing url) picks the trailing None
+        result[column] = values[codes]
+    return result if details else result["netloc"]
+
+
+SKU_PATTERN = r"\d{8}"
+
+
+@instrumentation.instrumented(rows=len)
+def extract_skus(df, columns, pattern=SKU_PATTERN, all_matches=False, max_matches=None, dtype="category", join=True):
     """
     Extract SKUS,
+    All the columns go through the compiled pattern in a single pass.
     :param df: dataframe where the SKU will be extracted from
     :param columns: columns where the SKU is.
-    :return: dataframe with f"{column}_sku for each column
+    :param pattern: regex of a SKU, default 8 digits
+    :param all_matches: every SKU found in a cell instead of the first one only
+    :param max_matches: with all_matches, keep at most max_matches SKUs per cell, there is then always
+    max_matches SKU columns per column (missing when fewer SKUs are found)
+    :param dtype: "category" or "int" (nullable Int64, SKUs that aren't numbers become missing)
+    :param join: join the SKU columns onto df, otherwise only return the SKU columns
+    :return: dataframe with f"{column}_sku" for each column,
+    f"{column}_sku_{n}" for the nth SKU of each column with all_matches
 
     """
     if type(columns) == str:
         columns = [columns]
+    compiled_pattern = re.compile(f"(?P<sku>{pattern})")
 
-    new_df = pd.DataFrame()
+    # positional index so that duplicated labels in df don't get in the way
+    stacked = pd.concat([df[column].reset_index(drop=True) for column in columns], keys=columns)
+    stacked = stacked.astype(str)
 
-    print(columns)
-    for column in columns:
-        new_df[column] = df.loc[:, column].astype(str)
-        new_column_name = "_".join([column, "sku"])
-        print(new_df.columns.values)
-        new_df[new_column_name] = new_df[column].str.extract("(\d{8})")
-        print(new_df[new_column_name].head())
+    sku_columns = {}
+    if len(df) == 0:
+        # nothing to match, the frame still gets its (empty) SKU columns
+        names = ([f"{column}_sku_{match}" for column in columns for match in range(max_matches or 1)]
+                 if all_matches else [f"{column}_sku" for column in columns])
+        sku_columns = {name: pd.Series([], dtype=object) for name in names}
+    elif all_matches:
+        matches = stacked.str.extractall(compiled_pattern)["sku"]
+        if max_matches is not None:
+            matches = matches[matches.index.get_level_values("match") < max_matches]
+        matches = matches.unstack("match")
+        for column in columns:
+            if column in matches.index.get_level_values(0):
+                column_matches = matches.xs(column, level=0)
+            else:
+                column_matches = pd.DataFrame(columns=[0], dtype=object)
+            column_matches = column_matches.reindex(range(len(df)))
+            if max_matches is not None:
+                column_matches = column_matches.reindex(columns=range(max_matches))
+            else:
+                # keep only as many SKU columns as this column has matches, at least one
+                column_matches = column_matches.loc[:, column_matches.notna().any().to_numpy() | (column_matches.columns == 0)]
+            for match in column_matches.columns:
+                sku_columns["_".join([column, "sku", str(match)])] = column_matches[match]
+    else:
+        matches = stacked.str.extract(compiled_pattern, expand=True)["sku"]
+        for column in columns:
+            sku_columns["_".join([column, "sku"])] = matches.xs(column, level=0)
 
+    new_df = pd.DataFrame(sku_columns, index=range(len(df)))
+    if dtype == "int":
+        new_df = pd.DataFrame({name: pd.to_numeric(skus, errors="coerce").astype("Int64") for name, skus in new_df.items()},
+                              index=new_df.index)
+    else:
+        new_df = new_df.astype("category")
+    new_df.index = df.index
+
+    if join:
+        return pd.concat([df, new_df], axis=1)
     return new_df
 
 
+@instrumentation.instrumented()
+def extract_skus_csv(filename, columns, output_file, chunksize=500000, max_workers=4, **kwargs):
+    """
+    extract_skus for csv files larger than memory, chunks are processed in parallel by a process pool
+    and appended in order to output_file.
+    kwargs are passed to extract_skus, all_matches needs max_matches so that every chunk has the same SKU columns
+    return:output_file
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    if type(columns) == str:
+        columns = [columns]
+    if kwargs.get("all_matches") and kwargs.get("max_matches") is None:
+        raise ValueError("all_matches needs max_matches, the csv header is written from the first chunk")
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        first_chunk = True
+
+        def write_oldest():
+            nonlocal first_chunk
+            result = pending.popleft().result()
+            instrumentation.add("rows", len(result))
+            result.to_csv(output_file, mode="w" if first_chunk else "a", header=first_chunk, index=False)
+            first_chunk = False
+
+        # SKU columns are read as text so that numbers aren't reformatted (ie: 12345678.0)
+        for chunk in pd.read_csv(filename, chunksize=chunksize, dtype={column: str for column in columns}):
+            pending.append(executor.submit(extract_skus, chunk, columns, **kwargs))
+            # bounded number of chunks in flight
+            if len(pending) > max_workers:
+                write_oldest()
+        while pending:
+            write_oldest()
+    return output_file
+
+
+HEAD_END = re.compile(rb"</head\s*>|<body[\s>]", re.IGNORECASE)
+
+
+def fetch_head(session, url, chunk_size=8192, max_bytes=2 * 1024 * 1024, **kwargs):
+    """
+    stream a page and stop reading as soon as the end of <head> is reached
+    return:(status_code, head bytes)
+    """
+    with session.get(url, stream=True, **kwargs) as response:
+        head = b""
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            head += chunk
+            match = HEAD_END.search(head, max(len(head) - len(chunk) - 16, 0))
+            if match:
+                head = head[:match.start()]
+                break
+            if len(head) >= max_bytes:
+                break
+        instrumentation.add("bytes", len(head))
+        return response.status_code, head
+
+
+def parse_hreflang_links(head):
+    """
+    return:list of (hreflang, href) found in the <link hreflang> tags of an html head
+    """
+    if not head.strip():
+        return []
+    html_object = lh.document_fromstring(head + b"</head></html>")
+    return [(link.get("hreflang").strip(), link.get("href", "").strip())
+            for link in html_object.xpath("//link[@hreflang]")]
+
+
 def get_hreflang_attribs(url="https://fr.myprotein.com"):
     """
     find equivalent page for the given locale
     (fr.myprotein after requesting us.myprotein.com
+    only the <head> of the page is downloaded and parsed
 
     """
-    html_requests = requests.get(url)
-    html_object = lh.fromstring(html_requests.text)
-    found_locales = html_object.xpath("//link[@hreflang]/@href")
-    found_language_codes = html_object.xpath("//link[@hreflang]/@hreflang")
+    status_code, head = fetch_head(requests.Session(), url)
+    found_links = parse_hreflang_links(head)
 
-    if len(found_locales) == 0:
-        return html_requests.status_code
+    if len(found_links) == 0:
+        return status_code
     else:
-        return zip(found_language_codes, found_locales)
+        return iter(found_links)
+
+
+@instrumentation.instrumented(kind="network", rows=len)
+def get_hreflang_batch(urls, headers=None, max_workers=32, per_host=4, timeout=30):
+    """
+    Fetch the hreflang links of many urls concurrently over pooled connections,
+    each page is only read until the end of its <head>.
+    urls:list of urls
+    headers:optional headers sent with every request (ie: user-agent)
+    return:dataframe of url, status_code, hreflang, href with one row per link
+    (a single row with empty hreflang/href when the page has none)
+    """
+    urls = list(urls)
+    hosts = {HOST_PATTERN.match(url).group(1) for url in urls}
+    session = getsitemaps.build_session(pool_size=max(per_host, 1), hosts=len(hosts))
+    if headers:
+        session.headers.update(headers)
+
+    records = []
+    for url, response in getsitemaps.fetch_urls(urls, session=session, max_workers=max_workers,
+                                                 per_host=per_host, timeout=timeout, request=fetch_head):
+        if response is None:
+            records.append((url, None, None, None))
+            continue
+        status_code, head = response
+        links = parse_hreflang_links(head)
+        records.extend((url, status_code, hreflang, href) for hreflang, href in links)
+        if not links:
+            records.append((url, status_code, None, None))
+    return pd.DataFrame(records, columns=["url", "status_code", "hreflang", "href"])
+
+
+@instrumentation.instrumented()
+def hreflang_graph(links_df):
+    """
+    Assemble the output of get_hreflang_batch into hreflang clusters and audit them.
+    return:dict of dataframes
+    clusters: url, cluster (connected pages through hreflang links)
+    missing_return_links: url, hreflang, href where href was crawled but doesn't link back to url
+    not_crawled: hreflang targets absent from the crawl, their return links can't be checked
+    conflicting_locales: url, hreflang, href, conflict where
+    "hreflang_with_several_hrefs": a page declares a same hreflang for several hrefs,
+    "href_with_several_locales": a page declares a same href under several locales (x-default aside,
+    x-default and a locale pointing to the same page is the expected setup),
+    "locale_claimed_by_several_pages": two pages of a same cluster are given the same locale
+    """
+    links = links_df.dropna(subset=["href"])
+    links = links[links["href"] != ""].reset_index(drop=True)
+    crawled = set(links_df["url"])
 
+    # union find over the urls to get the clusters
+    parent = {}
 
-def download_section(locale_codes, headers=""):
+    def find(node):
+        parent.setdefault(node, node)
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for url in crawled:
+        find(url)
+    for url, href in zip(links["url"], links["href"]):
+        parent[find(url)] = find(href)
+    clusters = pd.DataFrame({"url": list(parent)})
+    clusters["cluster"] = pd.factorize(clusters["url"].map(find))[0]
+
+    edges = set(zip(links["url"], links["href"]))
+    self_links = links["url"] == links["href"]
+    targets_crawled = links["href"].isin(crawled)
+    has_return = pd.Series([(href, url) in edges for url, href in zip(links["url"], links["href"])],
+                           index=links.index, dtype=bool)
+    missing_return_links = links[~self_links & targets_crawled & ~has_return]
+    not_crawled = links[~targets_crawled]
+
+    locales = links["hreflang"].str.lower()
+    real_locales = locales != "x-default"
+    link_clusters = links["url"].map(find)
+    hrefs_per_hreflang = links.groupby(["url", locales])["href"].transform("nunique")
+    locales_per_href = (links[real_locales].groupby(["url", "href"])["hreflang"].transform("nunique")
+                        .reindex(links.index, fill_value=0))
+    pages_per_locale = (links[real_locales].groupby([link_clusters[real_locales], locales[real_locales]])["href"]
+                        .transform("nunique").reindex(links.index, fill_value=0))
+    conflicts = {"hreflang_with_several_hrefs": hrefs_per_hreflang > 1,
+                 "href_with_several_locales": locales_per_href > 1,
+                 "locale_claimed_by_several_pages": pages_per_locale > 1}
+    conflicting_locales = pd.concat([links[mask].assign(conflict=conflict) for conflict, mask in conflicts.items()])
+
+    columns = ["url", "hreflang", "href"]
+    return {"clusters": clusters,
+            "missing_return_links": missing_return_links[columns].reset_index(drop=True),
+            "not_crawled": not_crawled[columns].reset_index(drop=True),
+            "conflicting_locales": conflicting_locales[columns + ["conflict"]].reset_index(drop=True)}
+
+
+class Throttle(object):
+    """
+    Thread safe limit of rate calls per second, wait() blocks until the next call is allowed.
+    rate None means no limit.
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1 / rate if rate else 0
+        self.next_call = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+@instrumentation.instrumented(kind="network")
+def download_file(session, url, output_filename, timeout=60, retries=3, chunk_size=1024 * 1024, throttle=None):
+    """
+    Stream url to output_filename through a temporary file renamed once complete,
+    so an interrupted download never leaves a truncated file behind.
+    The ETag and size of the download are kept in output_filename.meta.json, when the server
+    still advertises the same ones the body isn't downloaded again.
+    return:"downloaded", "unchanged" or "failed"
+    """
+    meta_filename = output_filename + ".meta.json"
+    previous = {}
+    if os.path.exists(output_filename) and os.path.exists(meta_filename):
+        with open(meta_filename, "r") as meta_file:
+            previous = json.load(meta_file)
+
+    for attempt in range(retries):
+        if throttle is not None:
+            throttle.wait()
+        try:
+            with session.get(url, stream=True, timeout=timeout) as response:
+                if response.status_code >= 500:
+                    raise requests.HTTPError(f"{response.status_code} server error", response=response)
+                response.raise_for_status()
+                meta = {"etag": response.headers.get("ETag"),
+                        "size": response.headers.get("Content-Length")}
+                if previous and ((meta["etag"] and meta["etag"] == previous.get("etag")) or
+                                 (not meta["etag"] and meta["size"] and meta["size"] == previous.get("size"))):
+                    return "unchanged"
+
+                tmp_filename = output_filename + ".part"
+                try:
+                    with open(tmp_filename, "wb") as response_csv:
+                        for chunk in response.iter_content(chunk_size=chunk_size):
+                            response_csv.write(chunk)
+                            instrumentation.add("bytes", len(chunk))
+                    os.replace(tmp_filename, output_filename)
+                finally:
+                    # a download failing midway doesn't leave its partial body behind
+                    if os.path.exists(tmp_filename):
+                        os.remove(tmp_filename)
+                with open(meta_filename, "w") as meta_file:
+                    json.dump(meta, meta_file)
+                return "downloaded"
+        except requests.RequestException as error:
+            print(url, error)
+            if error.response is not None and error.response.status_code < 500:
+                break
+            if attempt + 1 < retries:
+                instrumentation.add("retries")
+                time.sleep(2 ** attempt)
+    return "failed"
+
+
+@instrumentation.instrumented(kind="network")
+def download_section(locale_codes, headers="", max_workers=8, rate=1, retries=3, output_dir=""):
     """
     download all section id from the site importer
     takes as an input : authorised username, user-agent headers
     example of headers = {"Authorization":login,
                "User-Agent":"Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/70.0.3538.77 Safari/537.36"
                }
+    locales are downloaded concurrently (max_workers at a time) and streamed to disk,
+    rate caps the number of requests started per second (None for no limit),
+    failed downloads are retried and files unchanged on the server are skipped.
+    return:dict of locale code -> "downloaded", "unchanged" or "failed"
     """
-    for code in locale_codes:
+    session = getsitemaps.build_session(pool_size=max_workers, hosts=1)
+    session.verify = False
+    if headers:
+        session.headers.update(headers)
+    throttle = Throttle(rate)
+
+    urls = ["".join(["https://tools.io.thehut.local/api/site-importer/sites/", code, "/sections/download"])
+            for code in locale_codes]
+    output_filenames = {url: os.path.join(output_dir, "".join([code, "-", "section_id.csv"]))
+                        for code, url in zip(locale_codes, urls)}
+
+    def download(session, url, timeout=60, **kwargs):
+        return download_file(session, url, output_filenames[url], timeout=timeout, retries=retries, throttle=throttle)
+
+    results = {}
+    responses = getsitemaps.fetch_urls(urls,
+                                       session=session,
+                                       max_workers=max_workers,
+                                       per_host=max_workers,
+                                       timeout=60,
+                                       request=download)
+    for code, (url, status) in zip(locale_codes, responses):
+        results[code] = status or "failed"
+        print(status, output_filenames[url])
+    print("All good" if all(status != "failed" for status in results.values()) else "Some downloads failed")
+    return results
+
+
+def expand_files(files, extension=".csv"):
+    """
+    files: directory (every file with extension in it), glob pattern or list of files
+    return:list of files
+    """
+    if not isinstance(files, str):
+        return list(files)
+    pattern = os.path.join(files, "*" + extension) if os.path.isdir(files) else files
+    return sorted(glob.glob(pattern))
+
 
-        url = "".join(["https://tools.io.thehut.local/api/site-importer/sites/", code, "/sections/download"])
-        response = requests.get(url, headers=headers, verify=False)
-        print(response.url)
-        output_filename = "".join([code, "-", "section_id.csv"])
-        with open(output_filename, "wb") as response_csv:
-            response_csv.write(response.content)
-        print("created", output_filename)
-        time.sleep(1)
-    print("All good")
-    return None
+LIST_PAGE_PLACEHOLDER = "myprotein-rebrand"
+SECTION_ID_COLUMNS = ["enabled", "browserType", "fullPath"]
 
 
-def get_live_list_pages(section_id_df, site_list):
+def section_language_code(section_id_file):
     """
-    parse a section id_file and download
+    language code of a section id export, the second dash separated part of its name (ie: sections-en-2019.csv -> en)
+    """
+    return os.path.splitext(os.path.basename(section_id_file))[0].split("-")[1]
+
 
+def site_index(site_list):
+    """
+    return:dict language code -> site of a site_list dataframe with lc and site columns, first site of each code
     """
-    live_lists = section_id_df[(section_id_df["enabled"] == True) &
-                               (section_id_df["browserType"] == 0) &
-                               (section_id_df["fullPath"].str.contains("myprotein-rebrand"))]
+    sites = site_list.drop_duplicates("lc")
+    return dict(zip(sites["lc"], sites["site"]))
 
-    site_mapping = site_list
-    language_code = section_id_file.split("-")[1]
-    print(language_code)
-    locale = site_mapping.loc[site_mapping["lc"] == language_code, "site"]
-    locale = list(locale)[0]
-    live_lists["url"] = "https://" + live_lists["fullPath"].copy().str.replace("myprotein-rebrand", locale) + ".list"
-    output_name = "_".join(["urls", section_id_file])
 
-    live_lists["url"].to_csv(output_name, index=False)
+def live_list_urls(section_id_df, site):
+    """
+    urls of the enabled desktop list pages of a section id export, the placeholder of their path replaced by site
+    return:series of urls
+    """
+    live_lists = section_id_df.loc[section_id_df["enabled"].eq(True) &
+                                   section_id_df["browserType"].eq(0) &
+                                   section_id_df["fullPath"].str.contains(LIST_PAGE_PLACEHOLDER, regex=False),
+                                   "fullPath"]
+    return ("https://" + live_lists.str.replace(LIST_PAGE_PLACEHOLDER, site, regex=False) + ".list").rename("url")
+
+
+def get_live_list_pages(section_id_df, site_list, section_id_file, output_dir=""):
+    """
+    parse a section id_file and write the urls of its live list pages to urls_{section_id_file}
+    site_list: dataframe of lc / site or a site_index dict
+    return:output filename
+    """
+    sites = site_list if isinstance(site_list, dict) else site_index(site_list)
+    urls = live_list_urls(section_id_df, sites[section_language_code(section_id_file)])
+    output_name = os.path.join(output_dir, "_".join(["urls", os.path.basename(section_id_file)]))
+    urls.to_csv(output_name, index=False)
     return output_name
 
 
-def count_urls_by_type(df, column="Address"):
-    """breaks down all main types of urls"""
-    def remove_parameters(url):
-        sep = ("?")
-        return url.split(sep, 1)[0]
-
-    df["Address_no_parameters"] = df[column].apply(remove_parameters)
-    df.drop_duplicates(subset="Address_no_parameters", inplace=True)
-
-    all_lists = df[(df["Address_no_parameters"].str.contains(".list"))]
-    all_products = df[(df["Address_no_parameters"].str.contains(".html"))]
-    all_reviews = df[(df["Address_no_parameters"].str.contains(".reviews"))]
-    all_blogs = df[(df["Address_no_parameters"].str.contains("/thezone/")) |
-                   (df["Address_no_parameters"].str.contains("/blog/"))]
-    all_account = df[(df["Address_no_parameters"].str.contains(".account"))]
-    all_trade = df[(df["Address_no_parameters"].str.contains(".trade"))]
-    all_tesseract = df[(df["Address_no_parameters"].str.contains(".tesseract"))]
-    all_uploads_cdn = df[(df["Address_no_parameters"].str.contains(".uploads-cdn.thgblogs.com"))]
-
-    no_parameters_patt = "|".join(["/thezone/",
-                                   "/blog/",
-                                   "\.list",
-                                   "\.html",
-                                   "\.reviews",
-                                   "\.account",
-                                   "\.trade",
-                                   "\.tesseract",
-                                   "\.uploads-cdn.thgblogs.com"
-                                   ])
-
-    all_others = df[(df["Address_no_parameters"].str.contains(no_parameters_patt) == False)
-                    ]
-    non_indexable = df[(df["Address_no_parameters"].str.contains(".html"))]
-
-    print(all_others.head())
-    counts = {".list": len(all_lists),
-              ".html": len(all_products),
-              ".reviews": len(all_reviews),
-              "blog": len(all_blogs),
-              "other": len(all_others),
-              "account": len(all_account),
-              "trade": len(all_trade),
-              "tesseract": len(all_tesseract),
-              "cdn_url": len(all_uploads_cdn),
-              "total": len(df)
-              }
+def live_list_file(section_id_file, site, output_dir=None):
+    """
+    process pool worker of get_live_list_pages_batch
+    return:output filename, or a dataframe of section_file / url when output_dir is None
+    """
+    section_id_df = pd.read_csv(section_id_file, usecols=SECTION_ID_COLUMNS)
+    urls = live_list_urls(section_id_df, site)
+    if output_dir is None:
+        return pd.DataFrame({"section_file": os.path.basename(section_id_file), "url": urls.to_numpy()})
+    output_name = os.path.join(output_dir, "_".join(["urls", os.path.basename(section_id_file)]))
+    urls.to_csv(output_name, index=False)
+    return output_name
+
+
+@instrumentation.instrumented()
+def get_live_list_pages_batch(section_files, site_list, output_dir="", parquet_file=None, max_workers=4):
+    """
+    get_live_list_pages over many section id exports, processed in parallel by a process pool
+    section_files: directory (every csv in it), glob pattern or list of files
+    site_list: dataframe of lc / site, indexed once for all the files
+    parquet_file: when given, every url is written to this single parquet file (section_file / url columns)
+    instead of one urls_{section_file} csv per export
+    return:list of output filenames or the parquet file name, files without a known language code,
+    urls_ outputs and files without the SECTION_ID_COLUMNS are skipped
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    section_files = expand_files(section_files)
+    sites = site_index(site_list)
+
+    jobs = []
+    for section_id_file in section_files:
+        # outputs of a previous run written next to the exports aren't section id exports
+        if (os.path.basename(section_id_file).startswith("urls_")
+                or not set(SECTION_ID_COLUMNS) <= set(read_csv_header(section_id_file))):
+            print("not a section id export", section_id_file)
+            continue
+        try:
+            jobs.append((section_id_file, sites[section_language_code(section_id_file)]))
+        except (IndexError, KeyError):
+            print("no site for", section_id_file)
+
+    output_dir = None if parquet_file else output_dir
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(live_list_file, *zip(*jobs), [output_dir] * len(jobs))) if jobs else []
+
+    if parquet_file is None:
+        return results
+    urls = pd.concat(results, ignore_index=True) if results else pd.DataFrame(columns=["section_file", "url"])
+    instrumentation.add("rows", len(urls))
+    urls.astype({"section_file": "category"}).to_parquet(parquet_file, index=False)
+    return parquet_file
+
+
+URL_RULES = [(".list", ".list"),
+             (".html", ".html"),
+             (".reviews", ".reviews"),
+             ("blog", "/thezone/"),
+             ("blog", "/blog/"),
+             ("account", ".account"),
+             ("trade", ".trade"),
+             ("tesseract", ".tesseract"),
+             ("cdn_url", ".uploads-cdn.thgblogs.com"),
+             ]
+
+
+class UrlClassifier(object):
+    """
+    Assign one category to each url in a single compiled regex pass.
+    rules: list of (category, pattern) tuples, patterns are literal substrings unless regex=True.
+    The leftmost match in the url wins, ties are broken by the order of the rules.
+    urls matching no rule get the default category.
+    """
+
+    def __init__(self, rules=URL_RULES, default="other", regex=False):
+        self.rules = [(category, pattern if regex else re.escape(pattern)) for category, pattern in rules]
+        self.default = default
+        self.categories = list(dict.fromkeys([category for category, _ in self.rules] + [default]))
+        self.pattern = re.compile("(" + "|".join(pattern for _, pattern in self.rules) + ")")
+        self._rule_patterns = [(category, re.compile(pattern)) for category, pattern in self.rules]
+
+    def _category_of_match(self, matched):
+        for category, pattern in self._rule_patterns:
+            if pattern.fullmatch(matched):
+                return category
+        return self.default
+
+    def classify(self, urls):
+        """
+        urls: Series of urls
+        return: categorical Series with the category of each url
+        """
+        matched = urls.astype(str).str.extract(self.pattern, expand=False)
+        # only the distinct matched tokens are mapped back to their rule, usually a handful
+        lookup = {token: self._category_of_match(token) for token in matched.dropna().unique()}
+        categories = matched.map(lookup).fillna(self.default)
+        return pd.Series(pd.Categorical(categories, categories=self.categories), index=urls.index, name="url_type")
+
+    def count(self, urls):
+        """
+        return: dict of category -> count, with every category present
+        """
+        counts = self.classify(urls).value_counts()
+        return {category: int(counts.get(category, 0)) for category in self.categories}
+
+
+def remove_url_parameters(urls):
+    """
+    urls: Series of urls
+    return: Series of urls without their query string
+    """
+    return urls.astype(str).str.split("?", n=1).str[0]
+
+
+URL_PATTERN = (r"^(?P<scheme>[A-Za-z][A-Za-z0-9+.-]*)://(?:(?P<userinfo>[^/?#@]*)@)?(?P<host>[^/?#:@]*)"
+               r"(?::(?P<port>\d+))?(?P<path>[^?#]*)(?:\?(?P<query>[^#]*))?(?:#(?P<fragment>.*))?$")
+URL_PARTS = ["scheme", "userinfo", "host", "port", "path", "query", "fragment"]
+DEFAULT_PORTS = {"http": "80", "https": "443"}
+
+
+def split_urls(urls):
+    """
+    urls: Series of strings
+    return:(dataframe of the URL_PATTERN groups, boolean Series of the absolute urls), the regex runs in pyarrow
+    when installed (about twice as fast as str.extract)
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.compute as pc
+    except ImportError:
+        parts = urls.str.extract(URL_PATTERN)
+        return parts, parts["scheme"].notna()
+    matches = pc.extract_regex(pa.array(urls.to_numpy(dtype=object, na_value=None), type=pa.string()), URL_PATTERN)
+    parts = pd.DataFrame({name: matches.field(name).to_pandas() for name in URL_PARTS})
+    parts.index = urls.index
+    return parts, pd.Series(matches.is_valid().to_numpy(zero_copy_only=False), index=urls.index)
+
+
+class UrlCanonicalizer(object):
+    """
+    Vectorized url canonicalization, works on a whole Series at once.
+    keep_parameters: None keeps the query string, otherwise only these parameters are kept (empty: no query string)
+    sort_parameters: sort the kept parameters so that ?b=1&a=2 and ?a=2&b=1 are the same url
+    lowercase_host: lowercase scheme and host, paths are case sensitive and left as is
+    drop_default_port: remove :80 from http and :443 from https urls
+    drop_fragment: remove #fragment
+    trailing_slash: "strip" removes the trailing slash of paths (not of the root "/"), "keep" leaves them
+    values which aren't absolute urls are only stripped of surrounding spaces
+    """
+
+    def __init__(self, keep_parameters=(), sort_parameters=True, lowercase_host=True, drop_default_port=True,
+                 drop_fragment=True, trailing_slash="strip"):
+        self.keep_parameters = None if keep_parameters is None else set(keep_parameters)
+        self.sort_parameters = sort_parameters
+        self.lowercase_host = lowercase_host
+        self.drop_default_port = drop_default_port
+        self.drop_fragment = drop_fragment
+        self.trailing_slash = trailing_slash
+
+    def query(self, queries):
+        """
+        queries: Series of query strings of the urls having one
+        return: Series of filtered / sorted query strings, empty when nothing is kept
+        """
+        if self.keep_parameters is not None and not self.keep_parameters:
+            return pd.Series("", index=queries.index)
+        # parameters are grouped back by position, index labels can be duplicated
+        parameters = queries.reset_index(drop=True).str.split("&").explode()
+        parameters = parameters[parameters != ""]
+        if self.keep_parameters is not None:
+            parameters = parameters[parameters.str.split("=", n=1).str[0].isin(self.keep_parameters)]
+        if self.sort_parameters:
+            parameters = parameters.sort_values(kind="stable")
+        joined = parameters.groupby(level=0, sort=False).agg("&".join).reindex(range(len(queries)), fill_value="")
+        return joined.set_axis(queries.index)
+
+    def canonicalize(self, urls):
+        """
+        urls: Series of urls, missing values stay missing
+        return: Series of canonical urls with the same index
+        """
+        # the parts are aligned by position, the original index is put back at the end
+        index = urls.index
+        urls = urls.astype("string").str.strip().reset_index(drop=True)
+        parts, absolute = split_urls(urls)
+        if not absolute.any():
+            return urls.astype(object).set_axis(index)
+        parts = parts[absolute]
+
+        scheme = parts["scheme"]
+        host = parts["host"]
+        if self.lowercase_host:
+            scheme = scheme.str.lower()
+            host = host.str.lower()
+        port = parts["port"].fillna("")
+        if self.drop_default_port:
+            port = port.mask(port == scheme.map(DEFAULT_PORTS).fillna(""), "")
+        port = port.where(port == "", ":" + port)
+
+        path = parts["path"].mask(parts["path"] == "", "/")
+        if self.trailing_slash == "strip":
+            path = path.str.rstrip("/").mask(lambda stripped: stripped == "", "/")
+
+        query = parts["query"].fillna("")
+        has_query = query != ""
+        if has_query.any() and (self.keep_parameters is not None or self.sort_parameters):
+            query = query.mask(has_query, self.query(query[has_query]))
+        query = query.where(query == "", "?" + query)
+
+        userinfo = parts["userinfo"].fillna("")
+        userinfo = userinfo.where(userinfo == "", userinfo + "@")
+        canonical = scheme + "://" + userinfo + host + port + path + query
+        if not self.drop_fragment:
+            fragment = parts["fragment"].fillna("")
+            canonical = canonical + fragment.where(fragment == "", "#" + fragment)
+
+        result = urls.astype(object)
+        result[absolute] = canonical.astype(object)
+        return result.set_axis(index)
+
+
+def spill_buckets(aggregate, spill_dir, bits):
+    """
+    append an aggregate of hash / url / count to the bucket files of spill_dir, chosen with the top bits of the hash
+    """
+    buckets = (aggregate["hash"].to_numpy() >> np.uint64(64 - bits)).astype("int64")
+    for bucket, bucket_df in aggregate.groupby(buckets, sort=False):
+        path = os.path.join(spill_dir, f"bucket_{bucket}.csv")
+        bucket_df.to_csv(path, mode="a", header=not os.path.exists(path), index=False)
+
+
+def merge_aggregates(aggregate, chunk_aggregate):
+    """
+    sum the counts of two hash / url / count aggregates, the first url seen of each hash is kept
+    """
+    merged = pd.concat([aggregate, chunk_aggregate], ignore_index=True)
+    return merged.groupby("hash", sort=False).agg(url=("url", "first"), count=("count", "sum")).reset_index()
+
+
+@instrumentation.instrumented()
+def dedupe_urls(files, output_file, column="Address", canonicalizer=None, chunksize=1000000,
+                memory_budget=512 * 2 ** 20, spill_dir=None, spill_bits=6):
+    """
+    Canonicalize and deduplicate the urls of csv files larger than memory.
+    files are read by chunks, each url is canonicalized (see UrlCanonicalizer) and identified by its 64 bits hash,
+    with 50M distinct urls the odds of a collision merging two of them are below 1/10000.
+    The hash table stays in memory until its estimated size passes memory_budget bytes, it is then spilled to
+    2 ** spill_bits bucket files on disk (in spill_dir, a temporary folder by default), aggregated one by one at the end.
+    files: directory (every csv in it), glob pattern or list of csv files
+    output_file: csv with url (canonical) and count (number of rows of the files with this canonical url),
+    in order of first appearance when nothing was spilled
+    return:output_file
+    """
+    import tempfile
+
+    canonicalizer = canonicalizer or UrlCanonicalizer()
+    empty = pd.DataFrame({"hash": pd.Series(dtype="uint64"), "url": pd.Series(dtype=object),
+                          "count": pd.Series(dtype="int64")})
+    aggregate = empty
+    spill_folder = None
+    url_bytes = 0.0
+
+    try:
+        for filename in expand_files(files):
+            for chunk in pd.read_csv(filename, usecols=[column], dtype={column: str}, chunksize=chunksize):
+                urls = canonicalizer.canonicalize(chunk[column].dropna())
+                instrumentation.add("rows", len(urls))
+                if not len(urls):
+                    continue
+                hashes = pd.util.hash_pandas_object(urls, index=False).to_numpy()
+                chunk_aggregate = (pd.DataFrame({"hash": hashes, "url": urls.to_numpy()})
+                                   .groupby("hash", sort=False)
+                                   .agg(url=("url", "first"), count=("url", "size"))
+                                   .reset_index())
+                # hash, count, string object and its pointer in the table
+                url_bytes = max(url_bytes, urls.str.len().mean() + 49 + 24)
+                if spill_folder is not None:
+                    spill_buckets(chunk_aggregate, spill_folder, spill_bits)
+                    continue
+                aggregate = merge_aggregates(aggregate, chunk_aggregate)
+                if len(aggregate) * url_bytes > memory_budget:
+                    spill_folder = tempfile.mkdtemp(prefix="dedupe_urls_", dir=spill_dir)
+                    print("hash table over the memory budget, spilling to", spill_folder)
+                    spill_buckets(aggregate, spill_folder, spill_bits)
+                    aggregate = empty
+
+        if spill_folder is None:
+            aggregate[["url", "count"]].to_csv(output_file, index=False)
+            instrumentation.add("unique_urls", len(aggregate))
+            return output_file
+
+        first_bucket = True
+        for bucket in range(2 ** spill_bits):
+            path = os.path.join(spill_folder, f"bucket_{bucket}.csv")
+            if not os.path.exists(path):
+                continue
+            bucket_df = merge_aggregates(empty, pd.read_csv(path, dtype={"hash": "uint64", "url": str,
+                                                                         "count": "int64"}))
+            bucket_df[["url", "count"]].to_csv(output_file, mode="w" if first_bucket else "a",
+                                               header=first_bucket, index=False)
+            instrumentation.add("unique_urls", len(bucket_df))
+            first_bucket = False
+        if first_bucket:
+            empty[["url", "count"]].to_csv(output_file, index=False)
+        return output_file
+    finally:
+        if spill_folder is not None:
+            import shutil
+
+            shutil.rmtree(spill_folder, ignore_errors=True)
+
+
+@instrumentation.instrumented(rows=lambda counts: counts["total"])
+def count_urls_by_type(df, column="Address", rules=URL_RULES, canonicalizer=None):
+    """
+    breaks down all main types of urls, urls are deduplicated once their parameters are removed
+    or once canonicalized when a UrlCanonicalizer is given.
+    The dataframe passed is left untouched.
+    return: dict of counts by type with the total
+    """
+    if canonicalizer is None:
+        addresses = remove_url_parameters(df[column]).drop_duplicates()
+    else:
+        addresses = canonicalizer.canonicalize(df[column]).drop_duplicates()
+    counts = UrlClassifier(rules).count(addresses)
+    counts["total"] = len(addresses)
     print(counts)
+    return counts
 
+
+@instrumentation.instrumented(rows=lambda counts: counts["total"])
+def count_urls_by_type_csv(filename, column="Address", rules=URL_RULES, chunksize=1000000, canonicalizer=None):
+    """
+    Same as count_urls_by_type for csv files too large to fit in memory.
+    The file is read chunk by chunk, urls are deduplicated across chunks using their 64 bits hash.
+    return: dict of counts by type with the total
+    """
+    classifier = UrlClassifier(rules)
+    counts = dict.fromkeys(classifier.categories, 0)
+    seen_hashes = np.empty(0, dtype="uint64")
+    for chunk in pd.read_csv(filename, usecols=[column], chunksize=chunksize):
+        if canonicalizer is None:
+            addresses = remove_url_parameters(chunk[column])
+        else:
+            addresses = canonicalizer.canonicalize(chunk[column])
+        hashes = pd.util.hash_pandas_object(addresses, index=False).to_numpy()
+        new_urls = ~pd.Series(hashes).duplicated().to_numpy() & ~np.isin(hashes, seen_hashes)
+        seen_hashes = np.union1d(seen_hashes, hashes[new_urls])
+        instrumentation.add("rows_read", len(chunk))
+        for category, count in classifier.count(addresses[new_urls]).items():
+            counts[category] += count
+    counts["total"] = len(seen_hashes)
+    print(counts)
     return counts
 
 
-def check_presence(function, output_filename, files):
-    if output_filename not in files:
-        return function
+def check_presence(function, output_filename, files=None, *args, **kwargs):
+    """
+    call function(*args, **kwargs) unless output_filename already exists
+    files: manifest.Manifest (or list/set of file names) to look output_filename up in, default the disk
+    use Manifest.step to also rerun the steps whose inputs changed
+    return:result of function, None when skipped
+    """
+    if files is None:
+        present = os.path.exists(output_filename)
     else:
-        print(output_filename, "already exists, passing")
-        pass
+        present = output_filename in (files if isinstance(files, (set, manifest.Manifest)) else set(files))
+    if not present:
+        return function(*args, **kwargs)
+    print(output_filename, "already exists, passing")
+
+
+def read_csv_header(filename):
+    """
+    return:list of column names of a csv file, read from its first record only
+    """
+    with open(filename, "r", newline="", encoding="utf-8-sig") as csv_file:
+        return next(csv.reader(csv_file), [])
+
+
+def concat_csv_bytes(file_list, destination_file, buffer_size=16 * 1024 * 1024):
+    """
+    Byte level merge for csv files sharing the same header: the header of the first file is kept,
+    the header line of every other file is skipped and the rest is copied without any parsing.
+    """
+    with open(destination_file, "wb") as destination:
+        last_byte = b"\n"
+        for position, file in enumerate(file_list):
+            with open(file, "rb") as source:
+                header = source.readline()
+                if position == 0:
+                    destination.write(header)
+                    last_byte = header[-1:] or last_byte
+                if last_byte not in (b"\n", b""):
+                    destination.write(b"\n")
+                while block := source.read(buffer_size):
+                    destination.write(block)
+                    last_byte = block[-1:]
+    return destination_file
+
+
+def read_csv_reindexed(filename, columns, chunksize=100000):
+    """
+    read a csv as text, values are kept verbatim, and align it on columns
+    return:generator of dataframes of at most chunksize rows
+    """
+    for chunk in pd.read_csv(filename, dtype=str, keep_default_na=False, chunksize=chunksize):
+        yield chunk.reindex(columns=columns)
 
 
-def merge_csv_files(file_list=[], destination_file=str(uuid.uuid4())[:8] + "destination.csv"):
+def queue_csv_chunks(filename, columns, chunks, stop, chunksize=100000):
+    """
+    reader thread of merge_csv_files: puts the chunks of filename in the bounded chunks queue, then None
+    (or the error raised while reading). Gives up when stop is set, ie: the writer failed.
+    """
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    if stop.is_set():
+        return
+    try:
+        for chunk in read_csv_reindexed(filename, columns, chunksize):
+            if not put(chunk):
+                return
+    except Exception as error:
+        put(error)
+        return
+    put(None)
+
+
+@instrumentation.instrumented()
+def merge_csv_files(file_list=[], destination_file=None, output_format="csv", max_workers=4, chunksize=100000,
+                    queue_size=4):
     """
     Merge csv files together.
     To use when you're dealing with huge csv.
+    When all the files have the same header and the output is a csv, files are concatenated byte to byte
+    without parsing. Otherwise columns are unioned (in order of first appearance), the files are read in parallel
+    and missing columns are left empty. Values are kept as text so nothing is reformatted.
     file_list:list of file. absolute path recommended
-    destination_file:str default: str(uuid.uuid4())[:8] + "destination.csv"
+    destination_file:str default: str(uuid.uuid4())[:8] + "destination.csv" (or .parquet)
+    output_format:csv or parquet
+    max_workers:number of files read at the same time on the schema reconciling path
+    queue_size:chunks buffered per file being read, at most max_workers * queue_size chunks are held in memory
+    return:destination_file
     """
-    for file in file_list:
-        for chunk in pd.read_csv(file, chunksize=100000):
-            chunk.to_csv(destination_file, mode="a", index=False)
+    if output_format not in ("csv", "parquet"):
+        raise ValueError("output_format should be csv or parquet")
+    if destination_file is None:
+        destination_file = str(uuid.uuid4())[:8] + "destination." + output_format
+
+    headers = [read_csv_header(file) for file in file_list]
+    if output_format == "csv" and all(header == headers[0] for header in headers):
+        concat_csv_bytes(file_list, destination_file)
+        if instrumentation.is_enabled():
+            instrumentation.add("bytes", os.path.getsize(destination_file))
+        logger.info("finished")
+        return destination_file
+
+    columns = list(dict.fromkeys(column for header in headers for column in header))
+    writer = None
+    stop = threading.Event()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # readers run ahead on the next files, each one blocks once its queue is full, files are written in order
+        queues = [queue.Queue(maxsize=queue_size) for _ in file_list]
+        for file, chunks in zip(file_list, queues):
+            executor.submit(queue_csv_chunks, file, columns, chunks, stop, chunksize)
+        try:
+            for chunks in queues:
+                while (chunk := chunks.get()) is not None:
+                    if isinstance(chunk, Exception):
+                        raise chunk
+                    instrumentation.add("rows", len(chunk))
+                    if output_format == "csv":
+                        chunk.to_csv(destination_file, mode="a" if writer else "w", header=not writer, index=False)
+                        writer = True
+                    else:
+                        import pyarrow as pa
+                        import pyarrow.parquet as pq
+
+                        if writer is None:
+                            schema = pa.schema([(str(column), pa.string()) for column in columns])
+                            writer = pq.ParquetWriter(destination_file, schema)
+                        writer.write_table(pa.Table.from_pandas(chunk, schema=writer.schema, preserve_index=False))
+        finally:
+            stop.set()
+            # closing writes the parquet footer, even when a reader failed
+            if output_format == "parquet" and writer is not None:
+                writer.close()
+    if writer is None and output_format == "csv":
+        pd.DataFrame(columns=columns).to_csv(destination_file, index=False)
     logger.info("finished")
-    return None
+    return destination_file
 
 
 def get_page(url):
@@ -284,3 +1443,95 @@ def get_page(url):
 
     response = requests.get(url)
     return response
+
+
+def _lazy_dependencies(obj, seen=None):
+    """
+    LazyModule globals an object of this module relies on, following the functions, classes and instances of the module it uses
+    return:set of LazyModule
+    """
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return set()
+    seen.add(id(obj))
+
+    if isinstance(obj, type):
+        codes = [member.__code__ for member in vars(obj).values() if hasattr(member, "__code__")]
+        codes += [member.__func__.__code__ for member in vars(obj).values() if hasattr(getattr(member, "__func__", None), "__code__")]
+        codes += [member.fget.__code__ for member in vars(obj).values() if isinstance(member, property)]
+    else:
+        code = getattr(getattr(obj, "__wrapped__", obj), "__code__", None)
+        codes = [code] if code is not None else []
+
+    dependencies = set()
+    while codes:
+        code = codes.pop()
+        codes.extend(const for const in code.co_consts if hasattr(const, "co_names"))
+        for name in code.co_names:
+            value = globals().get(name)
+            if isinstance(value, LazyModule):
+                dependencies.add(value)
+                continue
+            # module level instances are followed through their class
+            code_owner = isinstance(value, type) or hasattr(getattr(value, "__wrapped__", value), "__code__")
+            target = value if code_owner else type(value)
+            if getattr(target, "__module__", None) == __name__:
+                dependencies |= _lazy_dependencies(target, seen)
+    return dependencies
+
+
+def _load_dependencies(name):
+    """
+    import everything the public function/class name needs
+    """
+    for module in _lazy_dependencies(globals()[name]):
+        module.load()
+
+
+def _public_functions():
+    return sorted(name for name, value in globals().items()
+                  if not name.startswith("_") and callable(value) and getattr(value, "__module__", None) == __name__
+                  and value not in (LazyModule, import_costs))
+
+
+def import_costs(names=None, repeat=1):
+    """
+    Cold import cost of each public function: a fresh interpreter imports this module
+    then everything the function needs, the time it takes is reported in seconds.
+    "utilities" is the cost of importing the module alone.
+    return:dict of name -> seconds
+    """
+    import subprocess
+
+    module_dir = os.path.dirname(os.path.abspath(__file__))
+    module_name = os.path.splitext(os.path.basename(__file__))[0]
+    names = _public_functions() if names is None else names
+    script = ("import sys, time; sys.path.insert(0, {dir!r}); start = time.perf_counter(); "
+              "import {module}; {load}; print(time.perf_counter() - start)")
+
+    costs = {}
+    for name in [None] + list(names):
+        load = f"{module_name}._load_dependencies({name!r})" if name else "None"
+        timings = []
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, "-c", script.format(dir=module_dir, module=module_name, load=load)],
+                                    capture_output=True, text=True, check=True).stdout
+            timings.append(float(output.strip().splitlines()[-1]))
+        costs[name or module_name] = min(timings)
+    return costs
+
+
+if __name__ == '__main__':
+    """
+    Import time regression check :
+    python utilities.py [budget in seconds for the module import alone, default 0.1]
+    exits with an error when importing the module goes over budget
+    """
+
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else 0.1
+    costs = import_costs(repeat=3)
+    for name, seconds in sorted(costs.items(), key=lambda cost: cost[1], reverse=True):
+        print(f"{seconds * 1000:10.1f} ms  {name}")
+    module_cost = costs[os.path.splitext(os.path.basename(__file__))[0]]
+    if module_cost > budget:
+        sys.exit(f"importing the module took {module_cost:.3f}s, over the {budget:.3f}s budget")